@@ -298,6 +298,30 @@ export const processJsonl = async (
   const rootMutations = root.mutations;
   root.mutations = [];
 
+  const mutations = new_data.header.mutations
+    ? new_data.header.mutations
+    : new_data.header.aa_mutations;
+
+  if (new_data.header.root_sequence) {
+    // Expand the compact [start, sequence] record of the root's nucleotides
+    // into one mutation per site, as older files store them
+    console.log("Expanding root sequence");
+    for (const [start, sequence] of new_data.header.root_sequence) {
+      for (let i = 0; i < sequence.length; i++) {
+        const mutation_id = mutations.length;
+        mutations.push({
+          gene: "nt",
+          previous_residue: "X",
+          residue_pos: start + i,
+          new_residue: sequence[i],
+          mutation_id: mutation_id,
+          type: "nt",
+        });
+        rootMutations.push(mutation_id);
+      }
+    }
+  }
+
   console.log("Creating output obj");
 
   const overwrite_config = new_data.header.config ? new_data.header.config : {};
@@ -310,9 +334,7 @@ export const processJsonl = async (
     overallMinX,
     overallMinY,
     y_positions,
-    mutations: new_data.header.mutations
-      ? new_data.header.mutations
-      : new_data.header.aa_mutations,
+    mutations: mutations,
     node_to_mut: new_data.node_to_mut,
     rootMutations: rootMutations,
     rootId: root.node_id,
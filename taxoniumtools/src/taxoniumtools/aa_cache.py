@@ -0,0 +1,144 @@
+"""Sidecar cache of amino acid annotations, reused between conversions.
+
+A node's amino acid mutations depend only on the reference and on the
+nucleotide mutations along its path from the root. Each node is keyed by a
+64-bit hash of that path, so when a tree is rebuilt with extra tips the
+annotations of every node whose path is unchanged can be looked up rather than
+recomputed.
+"""
+import hashlib
+import itertools
+import os
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+def splitmix64(x):
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def node_keys(tree, nuc_mutation_table):
+    """Hash of the nucleotide mutations on each node's path from the root"""
+    table = nuc_mutation_table
+    alphabet = np.array([ord(x) for x in table.alphabet], dtype=np.uint64)
+    packed = (table.position.astype(np.uint64) << np.uint64(16)
+              | alphabet[table.par_nuc] << np.uint64(8)
+              | alphabet[table.mut_nuc])
+    nuc_mutations = tree.ragged["nuc_mutations"]
+    # Summing per-mutation hashes makes each node's hash independent of the
+    # order its mutations are listed in
+    summed = np.concatenate([
+        np.zeros(1, dtype=np.uint64),
+        np.cumsum(splitmix64(packed)[nuc_mutations.values], dtype=np.uint64)
+    ])
+    own = (summed[nuc_mutations.offsets[1:]] -
+           summed[nuc_mutations.offsets[:-1]])
+    keys = np.zeros(tree.num_nodes(), dtype=np.uint64)
+    keys[0] = splitmix64(own[:1])[0]
+    for level in tree.levels()[1:]:
+        keys[level] = splitmix64(
+            splitmix64(keys[tree.parent[level]]) ^ own[level])
+    return keys
+
+
+def reference_digest(seq, codons):
+    """Identifies the reference and codon tables that annotations came from"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{FORMAT_VERSION}\n{seq}\n".encode())
+    digest.update("\t".join(codons.gene_names).encode())
+    for array in (codons.gene, codons.codon_number, codons.positions,
+                  codons.strand):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+class AACache:
+    """Distinct amino acid mutations as rows of gene, one_indexed_codon,
+    initial_aa and final_aa arrays, and the ids of those each key has"""
+
+    def __init__(self, keys, offsets, ids, rows):
+        self.keys = keys
+        self.offsets = offsets
+        self.ids = ids
+        self.rows = rows
+
+    @classmethod
+    def load(cls, filename, digest):
+        """The cache in filename, or None if there is no usable cache"""
+        if not os.path.exists(filename):
+            print(f"No amino acid cache found at {filename}, starting afresh")
+            return None
+        with np.load(filename) as data:
+            if str(data["digest"]) != digest:
+                print(
+                    f"Amino acid cache {filename} was made with a different reference, ignoring it"
+                )
+                return None
+            rows = {
+                "gene": data["gene_names"][data["gene"]],
+                "codon": data["codon"],
+                "initial_aa": data["initial_aa"],
+                "final_aa": data["final_aa"]
+            }
+            return cls(data["keys"], data["offsets"], data["ids"], rows)
+
+    def lookup(self, keys):
+        """For each key, its entry in the cache or -1 if it has none"""
+        entries = np.searchsorted(self.keys, keys)
+        entries[entries == len(self.keys)] = 0
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        return np.where(self.keys[entries] == keys, entries, -1)
+
+    def get(self, entry):
+        return self.ids[self.offsets[entry]:self.offsets[entry + 1]].tolist()
+
+    def packed_rows(self, codons):
+        """The rows as packed amino acid mutations of the given CodonTable"""
+        rows = self.rows
+        return codons.pack_mutations(
+            codons.find(rows["gene"].tolist(), rows["codon"] - 1),
+            ascii_codes(rows["initial_aa"]), ascii_codes(rows["final_aa"]))
+
+    @staticmethod
+    def save(filename, digest, keys, aa_muts, codons):
+        """Save the packed amino acid mutations of the first node with each
+        key"""
+        keys, first = np.unique(keys, return_index=True)
+        node_muts = [aa_muts[node] for node in first.tolist()]
+        counts = np.array([len(x) for x in node_muts], dtype=np.int64)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        packed = np.fromiter(itertools.chain.from_iterable(node_muts),
+                             dtype=np.int64,
+                             count=int(offsets[-1]))
+        rows, ids = np.unique(packed, return_inverse=True)
+        codon, initial_aa, final_aa = codons.unpack_mutations(rows)
+        with open(filename, "wb") as f:
+            np.savez_compressed(f,
+                                digest=np.array(digest),
+                                keys=keys,
+                                offsets=offsets,
+                                ids=ids.astype(np.int64),
+                                gene_names=np.array(codons.gene_names,
+                                                    dtype=str),
+                                gene=codons.gene[codon].astype(np.int64),
+                                codon=codons.codon_number[codon] + 1,
+                                initial_aa=ascii_chars(initial_aa),
+                                final_aa=ascii_chars(final_aa),
+                                nuc_for_codon=codons.positions[codon, 1])
+        print(f"Amino acid cache written to {filename}")
+
+
+def ascii_codes(chars):
+    """Codes of an array of one-character strings"""
+    return np.array(chars, dtype="S1").view(np.uint8).astype(np.int64)
+
+
+def ascii_chars(codes):
+    return np.asarray(codes, dtype=np.uint8).view("S1").astype(str)
@@ -0,0 +1,489 @@
+"""Compact, array-backed tree used by the conversion pipeline.
+
+Nodes are integer indices assigned in (left-to-right) preorder, so the root is
+node 0 and every node's parent has a smaller index than the node itself.
+Structure is held in a parent array plus a CSR child index, per-node numbers in
+NumPy columns, variable-length per-node values (e.g. mutation ids) in
+``RaggedColumn``s, and any other per-node Python objects in lists indexed by
+node. ``NodeView`` gives a treeswift-like object view for code that
+still wants to walk node objects.
+"""
+import math
+
+import numpy as np
+
+COLUMN_DTYPES = {"num_tips": np.int64}
+
+
+def gather_ranges(offsets, nodes, values):
+    """Concatenate values[offsets[n]:offsets[n + 1]] for each n in nodes"""
+    starts = offsets[nodes]
+    counts = offsets[nodes + 1] - starts
+    total = int(counts.sum())
+    if total == 0:
+        return values[:0]
+    run_starts = np.cumsum(counts) - counts
+    positions = np.arange(total) + np.repeat(starts - run_starts, counts)
+    return values[positions]
+
+
+class RaggedColumn:
+    """Variable-length per-node values, stored flat with CSR offsets.
+
+    If a table is given, values are ids into it: node views then see the
+    table's objects, and objects assigned through views are interned.
+    """
+
+    def __init__(self, offsets, values, table=None):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.values = np.asarray(values)
+        self.table = table
+
+    @classmethod
+    def from_lists(cls, lists, dtype, table=None):
+        lengths = np.fromiter((len(x) for x in lists),
+                              dtype=np.int64,
+                              count=len(lists))
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.fromiter((v for x in lists for v in x),
+                             dtype=dtype,
+                             count=int(offsets[-1]))
+        return cls(offsets, values, table)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def to_lists(self):
+        return [x.tolist() for x in np.split(self.values, self.offsets[1:-1])]
+
+    def take(self, indices):
+        """A new column holding the values of the given nodes, in order"""
+        lengths = self.lengths()[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return RaggedColumn(offsets,
+                            gather_ranges(self.offsets, indices, self.values),
+                            self.table)
+
+    def set(self, index, values):
+        values = np.asarray(values, dtype=self.values.dtype)
+        start, end = self.offsets[index], self.offsets[index + 1]
+        self.values = np.concatenate(
+            [self.values[:start], values, self.values[end:]])
+        self.offsets[index + 1:] += len(values) - (end - start)
+
+    def get_objects(self, index):
+        if self.table is None:
+            return self[index].tolist()
+        return self.table.objects(self[index])
+
+    def set_objects(self, index, objects):
+        if self.table is None:
+            self.set(index, objects)
+        else:
+            self.set(index, self.table.intern(objects))
+
+
+class ArrayTree:
+
+    def __init__(self, parent, labels, edge_length=None):
+        """parent must be in preorder, with -1 for the root at index 0"""
+        self.parent = np.asarray(parent, dtype=np.int64)
+        self.labels = list(labels)
+        self.columns = {}
+        self.ragged = {}
+        self.fields = {}
+        self.clades = {}
+        if edge_length is not None:
+            self.columns["edge_length"] = np.asarray(edge_length,
+                                                     dtype=np.float64)
+        self._build_child_index()
+
+    @classmethod
+    def from_treeswift(cls, tree):
+        parent = []
+        labels = []
+        edge_length = []
+        stack = [(tree.root, -1)]
+        while stack:
+            node, parent_index = stack.pop()
+            parent.append(parent_index)
+            labels.append(node.label)
+            edge_length.append(math.nan if node.edge_length is
+                               None else node.edge_length)
+            index = len(parent) - 1
+            stack.extend((child, index) for child in reversed(node.children))
+        return cls(parent, labels, edge_length)
+
+    def _build_child_index(self):
+        n = len(self.parent)
+        child_counts = np.bincount(self.parent[1:], minlength=n)
+        self.child_offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(child_counts, out=self.child_offsets[1:])
+        self.child_ids = np.argsort(self.parent[1:], kind="stable") + 1
+        self.is_leaf = child_counts == 0
+        self._levels = None
+        self._subtree_sizes = None
+        self._postorder = None
+        self._postorder_rank = None
+
+    def num_nodes(self):
+        return len(self.parent)
+
+    @property
+    def root(self):
+        return NodeView(self, 0)
+
+    def node(self, index):
+        return NodeView(self, index)
+
+    def children_of(self, index):
+        return self.child_ids[self.child_offsets[index]:self.
+                              child_offsets[index + 1]]
+
+    def children_lists(self):
+        """Mutable per-node lists of children, for use with restructure()"""
+        return [
+            x.tolist()
+            for x in np.split(self.child_ids, self.child_offsets[1:-1])
+        ]
+
+    def leaves(self):
+        return np.flatnonzero(self.is_leaf)
+
+    def levels(self):
+        """Arrays of node indices at each depth, starting with the root"""
+        if self._levels is None:
+            levels = []
+            frontier = np.zeros(1, dtype=np.int64)
+            while len(frontier):
+                levels.append(frontier)
+                frontier = gather_ranges(self.child_offsets, frontier,
+                                         self.child_ids)
+            self._levels = levels
+        return self._levels
+
+    def depths(self):
+        depth = np.empty(self.num_nodes(), dtype=np.int64)
+        for d, level in enumerate(self.levels()):
+            depth[level] = d
+        return depth
+
+    def sum_up(self, values):
+        """Sum values over each node's subtree (including the node itself)"""
+        totals = np.array(values, copy=True)
+        for level in reversed(self.levels()[1:]):
+            np.add.at(totals, self.parent[level], totals[level])
+        return totals
+
+    def subtree_sizes(self):
+        if self._subtree_sizes is None:
+            self._subtree_sizes = self.sum_up(
+                np.ones(self.num_nodes(), dtype=np.int64))
+        return self._subtree_sizes
+
+    def compute_num_tips(self):
+        return self.sum_up(self.is_leaf.astype(np.int64))
+
+    def postorder_rank(self):
+        """Position of each node in a left-to-right postorder traversal"""
+        if self._postorder_rank is None:
+            # Relative to preorder, a node moves behind its descendants and
+            # ahead of its ancestors
+            self._postorder_rank = (np.arange(self.num_nodes()) -
+                                    self.depths() + self.subtree_sizes() - 1)
+        return self._postorder_rank
+
+    def postorder(self):
+        if self._postorder is None:
+            order = np.empty(self.num_nodes(), dtype=np.int64)
+            order[self.postorder_rank()] = np.arange(self.num_nodes())
+            self._postorder = order
+        return self._postorder
+
+    def _views(self, indices, leaves=True, internal=True):
+        if not (leaves and internal):
+            indices = indices[self.is_leaf[indices] == leaves]
+        for index in indices.tolist():
+            yield NodeView(self, index)
+
+    # treeswift-compatible traversals. Note that treeswift's preorder visits
+    # children right-to-left, which is the reverse of a left-to-right postorder.
+
+    def traverse_preorder(self, leaves=True, internal=True):
+        return self.root.traverse_preorder(leaves=leaves, internal=internal)
+
+    def traverse_postorder(self, leaves=True, internal=True):
+        return self.root.traverse_postorder(leaves=leaves, internal=internal)
+
+    def traverse_leaves(self):
+        return self.root.traverse_leaves()
+
+    def get_column(self, name):
+        if name not in self.columns:
+            self.columns[name] = np.zeros(self.num_nodes(),
+                                          dtype=COLUMN_DTYPES.get(
+                                              name, np.float64))
+        return self.columns[name]
+
+    def get_field(self, name):
+        if name not in self.fields:
+            self.fields[name] = [None] * self.num_nodes()
+        return self.fields[name]
+
+    def append_nodes(self, labels, copy_from):
+        """Add detached nodes copying per-node data from the copy_from nodes.
+
+        The tree must be restructure()d or reorder()ed before it is used
+        again."""
+        copy_from = np.asarray(copy_from, dtype=np.int64)
+        start = self.num_nodes()
+        self.parent = np.concatenate(
+            [self.parent,
+             np.full(len(copy_from), -1, dtype=np.int64)])
+        self.labels.extend(labels)
+        for name, column in self.columns.items():
+            self.columns[name] = np.concatenate([column, column[copy_from]])
+        for name, column in self.ragged.items():
+            self.ragged[name] = column.take(
+                np.concatenate([np.arange(start), copy_from]))
+        for values in list(self.fields.values()) + list(self.clades.values()):
+            values.extend([values[i] for i in copy_from.tolist()])
+        return list(range(start, self.num_nodes()))
+
+    def restructure(self, children, root=0):
+        """Rebuild the tree from per-node lists of children.
+
+        Nodes not reachable from root are dropped and the remaining nodes are
+        renumbered in preorder."""
+        order = []
+        new_parent = []
+        stack = [(root, -1)]
+        while stack:
+            node, parent_index = stack.pop()
+            new_parent.append(parent_index)
+            order.append(node)
+            index = len(order) - 1
+            stack.extend((child, index) for child in reversed(children[node]))
+        self.reorder(order, new_parent)
+
+    def reorder(self, order, parent):
+        """Keep the nodes in order, which must be a preorder of them, giving
+        them parents by new index. Per-node data is permuted to match."""
+        order_array = np.asarray(order, dtype=np.int64)
+        order = order_array.tolist()
+        self.parent = np.asarray(parent, dtype=np.int64)
+        self.labels = [self.labels[i] for i in order]
+        for name, column in self.columns.items():
+            self.columns[name] = column[order_array]
+        for name, column in self.ragged.items():
+            self.ragged[name] = column.take(order_array)
+        for name, values in self.fields.items():
+            self.fields[name] = [values[i] for i in order]
+        for name, values in self.clades.items():
+            self.clades[name] = [values[i] for i in order]
+        self._build_child_index()
+
+    def ladderize(self, ascending=True):
+        """Sort each node's children in the same way as treeswift's ladderize:
+        by number of descendants, then edge length, then label, keeping the
+        current order of ties"""
+        n = self.num_nodes()
+        sizes = self.subtree_sizes()
+        edge_length = self.columns.get("edge_length")
+        if edge_length is None:
+            edge_length = np.full(n, np.nan)
+        has_length = ~np.isnan(edge_length)
+        length = np.where(has_length, edge_length, 0)
+        has_label = np.array([label is not None for label in self.labels])
+        label_rank = np.zeros(n, dtype=np.int64)
+        if has_label.any():
+            _, label_rank[has_label] = np.unique(np.array(
+                [label for label in self.labels if label is not None]),
+                                                 return_inverse=True)
+        sign = 1 if ascending else -1
+        # np.lexsort sorts by the last key first
+        nodes = np.arange(1, n)
+        child_ids = nodes[np.lexsort(
+            (nodes, sign * label_rank[1:], sign * has_label[1:],
+             sign * length[1:], sign * has_length[1:], sign * sizes[1:],
+             self.parent[1:]))]
+
+        # Each child comes after its parent and the subtrees of its earlier
+        # siblings
+        child_sizes = sizes[child_ids]
+        before = np.cumsum(child_sizes) - child_sizes
+        internal = ~self.is_leaf
+        before -= np.repeat(before[self.child_offsets[:-1][internal]],
+                            np.diff(self.child_offsets)[internal])
+        position = np.zeros(n, dtype=np.int64)
+        position[child_ids] = before + 1
+        for level in self.levels()[1:]:
+            position[level] += position[self.parent[level]]
+
+        order = np.empty(n, dtype=np.int64)
+        order[position] = np.arange(n)
+        parent = np.full(n, -1, dtype=np.int64)
+        parent[1:] = position[self.parent[order[1:]]]
+        levels = [np.sort(position[level]) for level in self.levels()]
+        self.reorder(order, parent)
+        # Depths and subtree sizes don't change, so these need not be
+        # recomputed
+        self._levels = levels
+        self._subtree_sizes = sizes[order]
+
+    def newick(self, lengths="edge_length"):
+        edge_length = self.columns.get(lengths)
+        suffix = "" if edge_length is None else branch_str(edge_length[0])
+        return self.root.newick(lengths) + suffix + ";"
+
+    def write_tree_newick(self, filename, lengths="edge_length"):
+        """Write the tree as Newick, with branch lengths from the given
+        column"""
+        with open(filename, "w") as f:
+            f.write(self.newick(lengths))
+
+
+UNSAFE_SYMBOLS = {';', '(', ')', ',', '[', ']', ':', "'"}
+
+
+def label_str(label):
+    if label is None:
+        return ''
+    label = str(label)
+    if any(c in label for c in UNSAFE_SYMBOLS):
+        return f"'{label}'"
+    return label
+
+
+def branch_str(length):
+    if math.isnan(length):
+        return ''
+    if length.is_integer():
+        return f":{int(length)}"
+    return f":{length}"
+
+
+class NodeView:
+    """A treeswift-like handle onto one node of an ArrayTree.
+
+    Attributes read and write the tree's columns, ragged columns and per-node
+    fields, so views are cheap to create and discard.
+    """
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree, index):
+        object.__setattr__(self, "tree", tree)
+        object.__setattr__(self, "index", index)
+
+    def __eq__(self, other):
+        return isinstance(other, NodeView) and (self.tree is other.tree
+                                                and self.index == other.index)
+
+    def __hash__(self):
+        return self.index
+
+    def __repr__(self):
+        return f"NodeView({self.index}, {self.label!r})"
+
+    @property
+    def label(self):
+        return self.tree.labels[self.index]
+
+    @label.setter
+    def label(self, value):
+        self.tree.labels[self.index] = value
+
+    @property
+    def parent(self):
+        parent = self.tree.parent[self.index]
+        return None if parent < 0 else NodeView(self.tree, int(parent))
+
+    @property
+    def children(self):
+        return [
+            NodeView(self.tree, child)
+            for child in self.tree.children_of(self.index).tolist()
+        ]
+
+    @property
+    def clades(self):
+        if not self.tree.clades:
+            raise AttributeError("clades")
+        return {
+            clade_type: values[self.index]
+            for clade_type, values in self.tree.clades.items()
+            if values[self.index] is not None
+        }
+
+    def is_leaf(self):
+        return bool(self.tree.is_leaf[self.index])
+
+    def is_root(self):
+        return self.index == 0
+
+    def __getattr__(self, name):
+        tree = object.__getattribute__(self, "tree")
+        index = object.__getattribute__(self, "index")
+        if name in tree.columns:
+            return tree.columns[name][index].item()
+        if name in tree.ragged:
+            return tree.ragged[name].get_objects(index)
+        if name in tree.fields:
+            return tree.fields[name][index]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in ("label", "tree", "index"):
+            object.__setattr__(self, name, value)
+        elif name in self.tree.ragged:
+            self.tree.ragged[name].set_objects(self.index, value)
+        elif isinstance(value, (int, float, np.number)):
+            self.tree.get_column(name)[self.index] = value
+        else:
+            self.tree.get_field(name)[self.index] = value
+
+    def _postorder_slice(self):
+        tree = self.tree
+        end = tree.postorder_rank()[self.index] + 1
+        return tree.postorder()[end - tree.subtree_sizes()[self.index]:end]
+
+    def traverse_preorder(self, leaves=True, internal=True):
+        """Visits children right-to-left, as treeswift does"""
+        return self.tree._views(self._postorder_slice()[::-1], leaves,
+                                internal)
+
+    def traverse_postorder(self, leaves=True, internal=True):
+        return self.tree._views(self._postorder_slice(), leaves, internal)
+
+    def traverse_leaves(self):
+        return self.traverse_preorder(internal=False)
+
+    def newick(self, lengths="edge_length"):
+        tree = self.tree
+        edge_length = tree.columns.get(lengths)
+        parts = []
+        stack = [(self.index, False)]
+        while stack:
+            node, closing = stack.pop()
+            if closing:
+                parts.append(")")
+            elif parts and parts[-1] != "(":
+                parts.append(",")
+            children = tree.children_of(node)
+            if len(children) and not closing:
+                parts.append("(")
+                stack.append((node, True))
+                stack.extend((child, False) for child in children[::-1])
+                continue
+            parts.append(label_str(tree.labels[node]))
+            if node != self.index and edge_length is not None:
+                parts.append(branch_str(edge_length[node]))
+        return "".join(parts)
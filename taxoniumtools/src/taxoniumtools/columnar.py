@@ -0,0 +1,287 @@
+"""Columnar binary version of the Taxonium jsonl format, as an Arrow IPC file.
+
+The file has one row per node, in the order of the node lines of the jsonl
+file, so it can be memory-mapped and read by any Arrow implementation without
+parsing the nodes. It is experimental and not part of the command line tools:
+Taxonium's viewers only load jsonl, and the whole file is built in memory
+before it is written. Convert a jsonl file to it, or back, with ``python -m
+taxoniumtools.columnar``, or pass output_format="arrow" to the converters'
+do_processing.
+
+The jsonl header line (version, mutations, config, ...) is stored as JSON in
+the schema metadata under "taxonium_header". Each key of the node objects is
+a column, in the same order:
+
+- name: string
+- x_dist, x_time (when there is a time tree) and y: float64. y is always
+  float64, and is written back to jsonl as an integer for tips, as in the
+  converters' output
+- mutations: list<int32> of mutation ids
+- is_tip: bool
+- parent_id, node_id, num_tips: int64
+- meta_*: int64, float64 or bool, with nulls where the jsonl has "", or
+  dictionary-encoded strings
+- clades: struct of dictionary-encoded strings
+
+Any column whose values don't share one of these types holds each value as
+JSON text, and has "json" set in its field metadata.
+"""
+import argparse
+import gzip
+
+import orjson
+import pyarrow as pa
+from alive_progress import alive_it
+
+HEADER_KEY = b"taxonium_header"
+BATCH_SIZE = 100000
+
+
+def value_kind(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, str):
+        return "empty" if value == "" else "str"
+    if isinstance(value, list):
+        return "list"
+    if isinstance(value, dict):
+        return "dict"
+    return "other"
+
+
+class TypeTracker:
+    """Collects the kinds of value seen for one key, to choose its type"""
+
+    def __init__(self):
+        self.kinds = set()
+        self.list_kinds = set()
+        self.fields = {}
+
+    def update(self, value):
+        kind = value_kind(value)
+        self.kinds.add(kind)
+        if kind == "list":
+            self.list_kinds.update(value_kind(x) for x in value)
+        elif kind == "dict":
+            for key, field_value in value.items():
+                self.fields.setdefault(key, TypeTracker()).update(field_value)
+
+    def field(self, name):
+        kinds = self.kinds - {"empty"}
+        if name == "y" and kinds <= {"int", "float"}:
+            return pa.field(name, pa.float64())
+        if not kinds or kinds == {"str"}:
+            if name == "name":
+                return pa.field(name, pa.string())
+            return pa.field(name, pa.dictionary(pa.int32(), pa.string()))
+        if len(kinds) == 1:
+            kind, = kinds
+            if kind == "bool":
+                return pa.field(name, pa.bool_())
+            if kind == "int":
+                return pa.field(name, pa.int64())
+            if kind == "float":
+                return pa.field(name, pa.float64())
+            if kind == "list" and self.list_kinds <= {"int"}:
+                return pa.field(name, pa.list_(pa.int32()))
+            if kind == "dict":
+                return pa.field(
+                    name,
+                    pa.struct([
+                        tracker.field(key)
+                        for key, tracker in self.fields.items()
+                    ]))
+        return pa.field(name, pa.string(), metadata={b"json": b"1"})
+
+
+def infer_schema(node_objects, value_hints=None):
+    """Schema for node objects, from the values of all of the given objects
+    and optionally further possible values for some keys"""
+    trackers = {}
+    for node_object in node_objects:
+        for key, value in node_object.items():
+            trackers.setdefault(key, TypeTracker()).update(value)
+    for key, values in (value_hints or {}).items():
+        for value in values:
+            trackers.setdefault(key, TypeTracker()).update(value)
+    return pa.schema([tracker.field(key) for key, tracker in trackers.items()])
+
+
+def is_json(field):
+    return field.metadata is not None and field.metadata.get(b"json") == b"1"
+
+
+def to_arrow_value(field, value):
+    if is_json(field):
+        return orjson.dumps(value).decode()
+    if pa.types.is_struct(field.type):
+        return {
+            subfield.name: to_arrow_value(subfield, value[subfield.name])
+            for subfield in field.type
+        }
+    if value == "" and not (pa.types.is_string(field.type)
+                            or pa.types.is_dictionary(field.type)):
+        return None
+    return value
+
+
+def from_arrow_value(field, value):
+    if is_json(field):
+        return orjson.loads(value)
+    if value is None:
+        return ""
+    if pa.types.is_struct(field.type):
+        return {
+            subfield.name: from_arrow_value(subfield, value[subfield.name])
+            for subfield in field.type
+        }
+    return value
+
+
+class ColumnarWriter:
+    """Writes node objects to a columnar file.
+
+    The schema is either given, or inferred from the first node object
+    together with value_hints, a dict of other values some keys can take.
+    Nodes are gathered as Arrow record batches, and the file is written on
+    close so that each dictionary-encoded column has a single dictionary.
+    """
+
+    def __init__(self,
+                 filename,
+                 header,
+                 schema=None,
+                 value_hints=None,
+                 batch_size=BATCH_SIZE):
+        self.filename = filename
+        self.header = header
+        self.schema = schema
+        self.value_hints = value_hints
+        self.batch_size = batch_size
+        self.batches = []
+        self.pending = []
+
+    def write(self, node_object):
+        if self.schema is None:
+            self.schema = infer_schema([node_object], self.value_hints)
+        self.pending.append(node_object)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        arrays = [
+            pa.array([
+                to_arrow_value(field, node_object[field.name])
+                for node_object in self.pending
+            ],
+                     type=field.type) for field in self.schema
+        ]
+        self.batches.append(
+            pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        if self.schema is None:
+            self.schema = infer_schema([], self.value_hints)
+        table = pa.Table.from_batches(
+            self.batches, schema=self.schema).replace_schema_metadata(
+                {HEADER_KEY: orjson.dumps(self.header)})
+        options = pa.ipc.IpcWriteOptions(unify_dictionaries=True)
+        with pa.OSFile(self.filename, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema,
+                                 options=options) as writer:
+                writer.write_table(table)
+
+
+def read_table(filename):
+    """The header and the memory-mapped table of nodes of a columnar file"""
+    reader = pa.ipc.open_file(pa.memory_map(filename, "r"))
+    header = orjson.loads(reader.schema.metadata[HEADER_KEY])
+    return header, reader.read_all()
+
+
+def iter_node_objects(table):
+    """Node objects as they appear in the jsonl format"""
+    fields = list(table.schema)
+    for batch in table.to_batches():
+        columns = [batch.column(field.name).to_pylist() for field in fields]
+        is_tip = batch.column("is_tip").to_pylist()
+        for row in range(batch.num_rows):
+            node_object = {
+                field.name: from_arrow_value(field, column[row])
+                for field, column in zip(fields, columns)
+            }
+            if is_tip[row] and isinstance(node_object.get("y"), float):
+                node_object["y"] = int(node_object["y"])
+            yield node_object
+
+
+def open_jsonl(filename, mode):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+def jsonl_to_columnar(input_file, output_file):
+    with open_jsonl(input_file, "rb") as f:
+        header = orjson.loads(f.readline())
+        schema = infer_schema(
+            orjson.loads(line)
+            for line in alive_it(f, title="Finding column types"))
+    writer = ColumnarWriter(output_file, header, schema=schema)
+    with open_jsonl(input_file, "rb") as f:
+        f.readline()
+        for line in alive_it(f, title="Converting nodes"):
+            writer.write(orjson.loads(line))
+    writer.close()
+
+
+def columnar_to_jsonl(input_file, output_file):
+    header, table = read_table(input_file)
+    with open_jsonl(output_file, "wb") as f:
+        f.write(orjson.dumps(header) + b"\n")
+        for node_object in alive_it(iter_node_objects(table),
+                                    total=table.num_rows,
+                                    title="Converting nodes"):
+            f.write(orjson.dumps(node_object) + b"\n")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description=
+        'Convert a Taxonium jsonl file to the columnar (Arrow) format, or back'
+    )
+    parser.add_argument(
+        '-i',
+        '--input',
+        type=str,
+        help=
+        'File path to input Taxonium file. Files ending in .arrow are converted to jsonl, anything else is read as jsonl (.jsonl / .jsonl.gz) and converted to .arrow',
+        required=True)
+    parser.add_argument('-o',
+                        '--output',
+                        type=str,
+                        help='File path for output file',
+                        required=True)
+    return parser
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.input.endswith(".arrow"):
+        columnar_to_jsonl(args.input, args.output)
+    else:
+        jsonl_to_columnar(args.input, args.output)
+    print(f"Done. Output written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Node coordinates for an ArrayTree, computed with NumPy a level at a time.
+
+The results are the same as those of walking the tree node by node: x is the
+sum of branch lengths from the root, normalised so that the 95th percentile
+is at a fixed value, tips are spaced one apart in y (in treeswift's
+right-to-left leaf order) and each internal node is halfway between the
+lowest and highest of its children. Coordinates are stored as columns of the
+tree, from which the writer reads them.
+"""
+import numpy as np
+
+from .arraytree import gather_ranges
+
+X_SCALE = 600
+
+
+def root_distances(tree, lengths, include_root=False):
+    """Sum of lengths along the path from the root to each node, counting
+    the root's own length if include_root is set"""
+    distances = np.zeros(tree.num_nodes(), dtype=np.float64)
+    if include_root:
+        distances[0] = lengths[0]
+    for level in tree.levels()[1:]:
+        distances[level] = distances[tree.parent[level]] + lengths[level]
+    return distances
+
+
+def normalise(values, fixed_val=X_SCALE):
+    """Scale values so that their 95th percentile is fixed_val"""
+    k = int(len(values) * 0.95)
+    percentile_95 = np.partition(values, k)[k]
+    if percentile_95 == 0:
+        raise ValueError(
+            "Can't normalise x coordinates: the 95th percentile of the distances from the root is 0"
+        )
+    return fixed_val * (values / percentile_95)
+
+
+def y_coords(tree):
+    y = np.zeros(tree.num_nodes(), dtype=np.float64)
+    leaves = tree.leaves()
+    y[leaves[::-1]] = np.arange(len(leaves))
+    # Children are one level below their parent, so going up from the deepest
+    # level every node's children are placed before the node itself
+    for level in reversed(tree.levels()[:-1]):
+        internal = level[~tree.is_leaf[level]]
+        starts = tree.child_offsets[internal]
+        counts = tree.child_offsets[internal + 1] - starts
+        child_ys = y[gather_ranges(tree.child_offsets, internal,
+                                   tree.child_ids)]
+        run_starts = np.cumsum(counts) - counts
+        y[internal] = (np.minimum.reduceat(child_ys, run_starts) +
+                       np.maximum.reduceat(child_ys, run_starts)) / 2
+    return y
+
+
+def set_coords(tree, chronumental_enabled):
+    """Set the x_dist, x_time and y columns of the tree"""
+    print("Setting coordinates")
+    tree.columns["x_dist"] = normalise(
+        root_distances(tree, tree.columns["edge_length"]))
+    if chronumental_enabled:
+        tree.columns["x_time"] = normalise(
+            root_distances(tree, tree.columns["time_length"]))
+    else:
+        tree.columns["x_time"] = np.zeros(tree.num_nodes(), dtype=np.float64)
+    tree.columns["y"] = y_coords(tree)
+    return tree.columns["x_dist"], tree.columns["x_time"], tree.columns["y"]
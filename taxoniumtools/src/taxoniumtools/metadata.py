@@ -0,0 +1,258 @@
+"""Columnar metadata tables, read with pyarrow's multithreaded CSV reader.
+
+Every column is stored dictionary-encoded: an array of integer codes, one per
+row, indexing a list of the column's distinct values (-1 where the value is
+missing). Rows are found by key through a hash index, so values can be read
+for any row without building a Python dict per sample.
+"""
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+from alive_progress import alive_it
+
+# pandas' default missing value markers, so files load the same as they did
+# with pd.read_csv
+NULL_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan",
+    "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a",
+    "nan", "null"
+]
+TRUE_VALUES = {"True", "TRUE", "true"}
+FALSE_VALUES = {"False", "FALSE", "false"}
+BLOCK_SIZE = 1 << 24
+
+
+def get_delimiter(metadata_file):
+    return "\t" if metadata_file.endswith(".tsv") or metadata_file.endswith(
+        ".tsv.gz") else ","
+
+
+def read_header(metadata_file, delimiter):
+    """The column names in the first line of the file"""
+    reader = pa_csv.open_csv(
+        metadata_file,
+        parse_options=pa_csv.ParseOptions(delimiter=delimiter),
+        convert_options=pa_csv.ConvertOptions(include_columns=[]))
+    return reader.schema.names
+
+
+def can_cast(values, arrow_type):
+    try:
+        pc.cast(values, arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return False
+    return True
+
+
+def value_kinds(values):
+    """Which of "int", "float" and "bool" all of the (non-missing) strings
+    can be read as"""
+    stripped = pc.utf8_trim_whitespace(values)
+    kinds = set()
+    if can_cast(pc.utf8_ltrim(stripped, "+"), pa.int64()):
+        kinds.add("int")
+    if can_cast(stripped, pa.float64()):
+        kinds.add("float")
+    if all(x in TRUE_VALUES or x in FALSE_VALUES
+           for x in pc.unique(stripped).to_pylist()):
+        kinds.add("bool")
+    return kinds
+
+
+def convert_values(values, kinds, has_missing):
+    """Python values for a column's distinct strings, typed as pandas would
+    infer them for the whole column: integers, floats, booleans or strings"""
+    stripped = pc.utf8_trim_whitespace(values)
+    if "int" in kinds and not has_missing:
+        return pc.cast(pc.utf8_ltrim(stripped, "+"), pa.int64()).to_pylist()
+    if "int" in kinds:
+        # Like pandas, integer columns with gaps become floats
+        return pc.cast(pc.cast(pc.utf8_ltrim(stripped, "+"), pa.int64()),
+                       pa.float64()).to_pylist()
+    if "float" in kinds:
+        return pc.cast(stripped, pa.float64()).to_pylist()
+    if "bool" in kinds:
+        return [x in TRUE_VALUES for x in stripped.to_pylist()]
+    return values.to_pylist()
+
+
+class ColumnSummary:
+    """What the values of a column read so far can be typed as"""
+
+    def __init__(self):
+        self.kinds = {"int", "float", "bool"}
+        self.has_missing = False
+
+    def update(self, column):
+        self.has_missing = self.has_missing or column.null_count > 0
+        if self.kinds:
+            self.kinds &= value_kinds(pc.unique(column).drop_null())
+
+
+def non_unique_keys_error(key_column):
+    return ValueError(
+        f"Error: The key column '{key_column}' contains non-unique values in the metadata file."
+    )
+
+
+class MetadataTable:
+    """Metadata columns for rows identified by key"""
+
+    def __init__(self, keys, columns, codes, values):
+        self.keys = keys
+        self.columns = columns
+        self.codes = codes
+        self.values = values
+        self._index = None
+
+    @classmethod
+    def empty(cls):
+        return cls(np.array([], dtype=object), [], {}, {})
+
+    @classmethod
+    def from_arrow(cls, table, key_column, summaries=None):
+        """Build from a pyarrow table whose columns are all strings.
+
+        Values are typed from summaries of the columns, by default of this
+        table's values."""
+        # Missing keys read as "nan", as they would with pandas
+        keys = table.column(key_column).fill_null("nan").to_numpy(
+            zero_copy_only=False)
+        columns = [name for name in table.column_names if name != key_column]
+        codes = {}
+        values = {}
+        for name in columns:
+            encoded = table.column(name).combine_chunks().dictionary_encode()
+            codes[name] = encoded.indices.fill_null(-1).to_numpy().astype(
+                np.int32)
+            if summaries is None:
+                summary = ColumnSummary()
+                summary.update(encoded.dictionary)
+                summary.has_missing = encoded.null_count > 0
+            else:
+                summary = summaries[name]
+            values[name] = convert_values(encoded.dictionary, summary.kinds,
+                                          summary.has_missing)
+        metadata = cls(keys, columns, codes, values)
+        if not metadata.index.is_unique:
+            raise non_unique_keys_error(key_column)
+        return metadata
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = pd.Index(self.keys, dtype=object)
+        return self._index
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys):
+        """The row of each key, or -1 for keys not in the table"""
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        return self.index.get_indexer(pd.Index(keys, dtype=object))
+
+    def column_codes(self, name, rows):
+        """The codes of a column's values in the given rows, with -1 for
+        missing values and for rows that are -1"""
+        codes = self.codes[name]
+        rows = np.asarray(rows, dtype=np.int64)
+        # Rows added after a column was stop short of it, and have no value
+        stored = (rows >= 0) & (rows < len(codes))
+        result = np.full(len(rows), -1, dtype=np.int32)
+        result[stored] = codes[rows[stored]]
+        return result
+
+    def get(self, row):
+        """(column, value) pairs for a row, with missing values as "" """
+        pairs = []
+        for name in self.columns:
+            codes = self.codes[name]
+            code = codes[row] if row < len(codes) else -1
+            pairs.append((name, self.values[name][code] if code >= 0 else ""))
+        return pairs
+
+    def add_column(self, name, keys, column_values):
+        """Add a column with values given per key, joined to the table's
+        rows by key.
+
+        Keys that are not yet in the table (e.g. internal nodes) get rows of
+        their own, but the existing columns are not extended to cover them,
+        so these rows only take space in the new column."""
+        rows = self.lookup(keys)
+        added = rows < 0
+        if np.any(added):
+            rows[added] = np.arange(len(self.keys),
+                                    len(self.keys) + np.count_nonzero(added))
+            self.keys = np.concatenate(
+                [self.keys, np.asarray(keys, dtype=object)[added]])
+            self._index = None
+        column_codes, uniques = pd.factorize(pd.Series(column_values,
+                                                       dtype=object),
+                                             use_na_sentinel=True)
+        self.codes[name] = np.full(len(self.keys), -1, dtype=np.int32)
+        self.codes[name][rows] = column_codes
+        self.values[name] = uniques.tolist()
+        self.columns.append(name)
+
+
+def read_metadata_table(metadata_file, columns, key_column, keys=None):
+    """Read the key column and the requested columns of a CSV/TSV file.
+
+    If keys is given, the file is streamed in blocks and only rows with
+    those keys are kept. Values are still typed according to the whole
+    file, and every key in the file must still be unique, so the result
+    matches that of reading every row."""
+    delimiter = get_delimiter(metadata_file)
+    header = read_header(metadata_file, delimiter)
+    wanted = set(columns) | {key_column}
+    missing = sorted(wanted - set(header))
+    if missing:
+        raise ValueError(
+            f"Columns {', '.join(missing)} were requested but are not in the metadata file {metadata_file}"
+        )
+    include_columns = [name for name in header if name in wanted]
+    read_options = pa_csv.ReadOptions(use_threads=True, block_size=BLOCK_SIZE)
+    parse_options = pa_csv.ParseOptions(delimiter=delimiter)
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=include_columns,
+        column_types={name: pa.string()
+                      for name in include_columns},
+        null_values=NULL_VALUES,
+        strings_can_be_null=True,
+        quoted_strings_can_be_null=True)
+    if keys is None:
+        table = pa_csv.read_csv(metadata_file,
+                                read_options=read_options,
+                                parse_options=parse_options,
+                                convert_options=convert_options)
+        return MetadataTable.from_arrow(table, key_column)
+
+    keys = pa.array(list(keys), type=pa.string())
+    summaries = {
+        name: ColumnSummary()
+        for name in include_columns if name != key_column
+    }
+    batches = []
+    # Every key is kept to check that they are unique, as when reading
+    # every row
+    file_keys = []
+    reader = pa_csv.open_csv(metadata_file,
+                             read_options=read_options,
+                             parse_options=parse_options,
+                             convert_options=convert_options)
+    for batch in alive_it(reader, title="Reading metadata"):
+        for name, summary in summaries.items():
+            summary.update(batch.column(name))
+        file_keys.append(batch.column(key_column).fill_null("nan"))
+        batches.append(
+            batch.filter(pc.is_in(batch.column(key_column), value_set=keys)))
+    file_keys = pa.chunked_array(file_keys, type=pa.string())
+    if pc.count_distinct(file_keys).as_py() != len(file_keys):
+        raise non_unique_keys_error(key_column)
+    table = pa.Table.from_batches(batches, schema=reader.schema)
+    print(f"Kept metadata for {len(table)} of the tree's {len(keys)} names")
+    return MetadataTable.from_arrow(table, key_column, summaries)
@@ -0,0 +1,334 @@
+"""Fast Newick parsing straight into preorder index arrays.
+
+The parser is vectorised over the bytes of the Newick string with NumPy rather
+than walking it character by character. Nodes are numbered in the order their
+opening "(" or "," appears, which is a left-to-right preorder, so for UShER
+protobufs the result lines up with ``data.node_mutations``. Newick files are
+read in chunks by ``NewickStreamParser``, which applies the same approach to
+one chunk at a time.
+"""
+import gzip
+
+import numpy as np
+
+STRUCTURAL = b"(),:;"
+STRUCTURAL_TABLE = np.zeros(256, dtype=bool)
+STRUCTURAL_TABLE[list(STRUCTURAL)] = True
+OPEN, CLOSE, COMMA, COLON, SEMICOLON = STRUCTURAL
+START = 0  # marks a virtual structural character just before the string
+
+
+def concatenated_ranges(starts, lengths):
+    """Concatenation of arange(s, s + l) for each start s and length l"""
+    total = int(lengths.sum())
+    run_starts = np.cumsum(lengths) - lengths
+    return np.arange(total) + np.repeat(starts - run_starts, lengths)
+
+
+def extract_segments(chars, starts, ends):
+    """Decode each chars[start:end] as a string"""
+    lengths = ends - starts
+    # Copy each segment followed by a newline separator, then split once
+    out = np.full(int(lengths.sum()) + len(lengths), ord("\n"), dtype=np.uint8)
+    out_starts = np.cumsum(lengths + 1) - (lengths + 1)
+    out[concatenated_ranges(out_starts, lengths)] = chars[concatenated_ranges(
+        starts, lengths)]
+    return out.tobytes().decode().split("\n")[:-1]
+
+
+def last_node_before(node_keys, node_order, depth, position, stride):
+    """For each (depth, position) query, find the last node created before
+    position at that depth."""
+    found = np.searchsorted(node_keys, depth * stride + position) - 1
+    return node_order[found]
+
+
+def parse_newick(newick):
+    """Parse a Newick string into (parent, labels, edge_length).
+
+    parent holds preorder parent indices with -1 for the root, labels holds
+    None for unlabelled nodes, and edge_length holds NaN where no length is
+    given. Labels are taken verbatim: UShER writes them unquoted, so quote
+    characters are kept as part of the label rather than interpreted.
+    """
+    if isinstance(newick, str):
+        newick = newick.encode()
+    chars = np.frombuffer(newick, dtype=np.uint8)
+    positions = np.concatenate([[-1],
+                                np.flatnonzero(STRUCTURAL_TABLE[chars])
+                                ]).astype(np.int64)
+    symbols = np.concatenate([[START], chars[positions[1:]]])
+
+    depth = np.cumsum((symbols == OPEN).astype(np.int64) - (symbols == CLOSE))
+    if depth.min() < 0 or depth[-1] != 0:
+        raise ValueError("Unbalanced parentheses in Newick string")
+
+    # The root exists from the start, and every "(" or "," creates a node
+    creates = (symbols == START) | (symbols == OPEN) | (symbols == COMMA)
+    node_positions = positions[creates]
+    node_depths = depth[creates]
+    num_nodes = len(node_positions)
+
+    stride = len(chars) + 2
+    node_keys = node_depths * stride + node_positions + 1
+    node_order = np.argsort(node_keys)
+    node_keys = node_keys[node_order]
+
+    parent = np.full(num_nodes, -1, dtype=np.int64)
+    parent[1:] = last_node_before(node_keys, node_order, node_depths[1:] - 1,
+                                  node_positions[1:] + 1, stride)
+    if np.any(node_depths[parent[1:]] != node_depths[1:] - 1):
+        raise ValueError("Malformed Newick string")
+
+    # Work out which node each piece of text between structural characters
+    # describes: a created node, the node a ")" returns to, or (after ":" and
+    # ";") whichever node the previous character referred to
+    current = np.full(len(symbols), -1, dtype=np.int64)
+    current[creates] = np.arange(num_nodes)
+    closes = np.flatnonzero(symbols == CLOSE)
+    current[closes] = last_node_before(node_keys, node_order, depth[closes],
+                                       positions[closes] + 1, stride)
+    defined = np.where(current >= 0, np.arange(len(symbols)), 0)
+    current = current[np.maximum.accumulate(defined)]
+
+    text_starts = positions + 1
+    text_ends = np.concatenate([positions[1:], [len(chars)]])
+    has_text = text_ends > text_starts
+    is_length = symbols == COLON
+    if np.any(has_text & (symbols == SEMICOLON)):
+        raise ValueError("Unexpected text after ';' in Newick string")
+
+    labels = np.full(num_nodes, None, dtype=object)
+    label_segments = np.flatnonzero(has_text & ~is_length
+                                    & (symbols != SEMICOLON))
+    labels[current[label_segments]] = extract_segments(
+        chars, text_starts[label_segments], text_ends[label_segments])
+
+    edge_length = np.full(num_nodes, np.nan)
+    length_segments = np.flatnonzero(has_text & is_length)
+    edge_length[current[length_segments]] = np.array(extract_segments(
+        chars, text_starts[length_segments], text_ends[length_segments]),
+                                                     dtype=np.float64)
+    return parent, labels.tolist(), edge_length
+
+
+CHUNK_SIZE = 1 << 20
+WHITESPACE = b" \t\r\n"
+QUOTE = ord("'")
+COMMENT_OPEN, COMMENT_CLOSE = b"[]"
+# Characters that can change whether the text after them is in a comment or
+# quoted
+SPECIAL_TABLE = np.zeros(256, dtype=bool)
+SPECIAL_TABLE[[COMMENT_OPEN, COMMENT_CLOSE, QUOTE]] = True
+
+
+class NewickStreamParser:
+    """Parses Newick text fed to it a chunk at a time into the same arrays
+    as parse_newick, so a large file never has to be held in memory.
+
+    Whitespace is dropped as it is read, [comments] are skipped and labels
+    may be quoted, as treeswift reads them. Each chunk is parsed up to its
+    last structural character with the same vectorised approach as
+    parse_newick; the nodes on the path to where parsing stopped are carried
+    over to the next chunk as if they appeared at its start.
+    """
+
+    def __init__(self):
+        self.num_nodes = 1
+        self.parents = [np.full(1, -1, dtype=np.int64)]
+        self.label_nodes = []
+        self.labels = []
+        self.length_nodes = []
+        self.lengths = []
+        # The open nodes at each depth, the node that text refers to, and
+        # the structural character before that text
+        self.path = np.zeros(1, dtype=np.int64)
+        self.current = 0
+        self.last_symbol = START
+        self.ended = False
+        # Text after the last structural character, which is parsed with
+        # the next chunk
+        self.pending = b""
+        self.pending_quoted = np.zeros(0, dtype=bool)
+        self.in_quote = False
+        self.comment_depth = 0
+
+    def remove_comments(self, data):
+        """data without [comments], and whether each remaining character is
+        inside quotes"""
+        if self.comment_depth == 0 and b"[" not in data:
+            if not self.in_quote and b"'" not in data:
+                return data, np.zeros(len(data), dtype=bool)
+            # A character is quoted if an odd number of quotes precede it
+            quotes = np.frombuffer(data, dtype=np.uint8) == QUOTE
+            quoted = np.logical_xor.accumulate(quotes) ^ quotes
+            if self.in_quote:
+                quoted = ~quoted
+            self.in_quote = self.in_quote ^ bool(np.count_nonzero(quotes) % 2)
+            return data, quoted
+        chars = np.frombuffer(data, dtype=np.uint8)
+        if not self.in_quote and b"'" not in data:
+            # The nesting depth after each character is a running sum of its
+            # "[" and "]", except that a stray "]" can't take it below 0
+            totals = self.comment_depth + np.cumsum(
+                (chars == COMMENT_OPEN).astype(np.int64) -
+                (chars == COMMENT_CLOSE))
+            depth = totals - np.minimum(np.minimum.accumulate(totals), 0)
+            before = np.concatenate([[self.comment_depth], depth[:-1]])
+            kept = (before == 0) & (chars != COMMENT_OPEN)
+            if len(depth):
+                self.comment_depth = int(depth[-1])
+            return chars[kept].tobytes(), np.zeros(np.count_nonzero(kept),
+                                                   dtype=bool)
+        # Otherwise quotes and comments affect each other, so the state is
+        # followed from one special character to the next, and each run of
+        # other characters takes the state after the special character
+        # before it
+        special = np.flatnonzero(SPECIAL_TABLE[chars])
+        kept_after = np.empty(len(special) + 1, dtype=bool)
+        quoted_after = np.empty(len(special) + 1, dtype=bool)
+        special_kept = np.empty(len(special), dtype=bool)
+        kept_after[0] = self.comment_depth == 0
+        quoted_after[0] = self.in_quote
+        for i, c in enumerate(chars[special].tolist()):
+            special_kept[i] = self.comment_depth == 0
+            if self.comment_depth:
+                if c == COMMENT_OPEN:
+                    self.comment_depth += 1
+                elif c == COMMENT_CLOSE:
+                    self.comment_depth -= 1
+            elif c == QUOTE:
+                self.in_quote = not self.in_quote
+            elif c == COMMENT_OPEN and not self.in_quote:
+                self.comment_depth = 1
+                special_kept[i] = False
+            kept_after[i + 1] = self.comment_depth == 0
+            quoted_after[i + 1] = self.in_quote
+        is_special = np.zeros(len(chars), dtype=np.int64)
+        is_special[special] = 1
+        state = np.cumsum(is_special)
+        kept = kept_after[state]
+        kept[special] = special_kept
+        quoted = quoted_after[state]
+        return chars[kept].tobytes(), quoted[kept]
+
+    def feed(self, data, final=False):
+        data, quoted = self.remove_comments(data.translate(None, WHITESPACE))
+        data = self.pending + data
+        quoted = np.concatenate([self.pending_quoted, quoted])
+        chars = np.frombuffer(data, dtype=np.uint8)
+        structural = np.flatnonzero(STRUCTURAL_TABLE[chars] & ~quoted)
+        end = len(chars) if final else (int(structural[-1]) +
+                                        1 if len(structural) else 0)
+        self.pending = data[end:]
+        self.pending_quoted = quoted[end:]
+        if end:
+            self.parse(chars[:end], structural[structural < end])
+
+    def parse(self, chars, structural):
+        positions = np.concatenate([[-1], structural]).astype(np.int64)
+        symbols = np.concatenate([
+            np.array([self.last_symbol], dtype=np.uint8), chars[positions[1:]]
+        ])
+        semicolons = np.flatnonzero(symbols[1:] == SEMICOLON)
+        if (self.ended
+                and len(symbols) > 1) or np.any(semicolons < len(symbols) - 2):
+            raise ValueError("Unexpected text after ';' in Newick string")
+
+        steps = (symbols == OPEN).astype(np.int64) - (symbols == CLOSE)
+        steps[0] = 0
+        depth = len(self.path) - 1 + np.cumsum(steps)
+        if depth.min() < 0:
+            raise ValueError("Unbalanced parentheses in Newick string")
+
+        # Every "(" or "," creates a node. The nodes on the path so far act
+        # as if they were created just before this chunk.
+        creates = (symbols == OPEN) | (symbols == COMMA)
+        creates[0] = False
+        node_positions = positions[creates]
+        node_depths = depth[creates]
+        new_nodes = self.num_nodes + np.arange(len(node_positions))
+        stride = len(chars) + 2
+        known_depths = np.concatenate([np.arange(len(self.path)), node_depths])
+        known_keys = known_depths * stride + np.concatenate(
+            [np.zeros(len(self.path), dtype=np.int64), node_positions + 1])
+        order = np.argsort(known_keys, kind="stable")
+        known_keys = known_keys[order]
+        known_depths = known_depths[order]
+        known_nodes = np.concatenate([self.path, new_nodes])[order]
+
+        def last_node_before(depths, positions):
+            found = np.searchsorted(known_keys, depths * stride + positions)
+            found -= 1
+            if np.any(found < 0) or np.any(known_depths[found] != depths):
+                raise ValueError("Malformed Newick string")
+            return known_nodes[found]
+
+        self.parents.append(
+            last_node_before(node_depths - 1, node_positions + 1))
+        current = np.full(len(symbols), -1, dtype=np.int64)
+        current[0] = self.current
+        current[creates] = new_nodes
+        closes = np.flatnonzero(symbols[1:] == CLOSE) + 1
+        current[closes] = last_node_before(depth[closes],
+                                           positions[closes] + 1)
+        defined = np.where(current >= 0, np.arange(len(symbols)), 0)
+        current = current[np.maximum.accumulate(defined)]
+
+        text_starts = positions + 1
+        text_ends = np.concatenate([positions[1:], [len(chars)]])
+        has_text = text_ends > text_starts
+        is_length = symbols == COLON
+        if np.any(has_text & (symbols == SEMICOLON)):
+            raise ValueError("Unexpected text after ';' in Newick string")
+        label_segments = np.flatnonzero(has_text & ~is_length
+                                        & (symbols != SEMICOLON))
+        labels = extract_segments(chars, text_starts[label_segments],
+                                  text_ends[label_segments])
+        if np.any(chars == QUOTE):
+            labels = [label.replace("'", "") for label in labels]
+        self.label_nodes.append(current[label_segments])
+        self.labels.extend(labels)
+        length_segments = np.flatnonzero(has_text & is_length)
+        self.length_nodes.append(current[length_segments])
+        self.lengths.append(
+            np.array(extract_segments(chars, text_starts[length_segments],
+                                      text_ends[length_segments]),
+                     dtype=np.float64))
+
+        end = len(chars) + 1
+        self.path = last_node_before(np.arange(depth[-1] + 1),
+                                     np.full(depth[-1] + 1, end))
+        self.current = int(current[-1])
+        self.last_symbol = int(symbols[-1])
+        self.ended = self.ended or len(semicolons) > 0
+        self.num_nodes += len(new_nodes)
+
+    def result(self):
+        """(parent, labels, edge_length), as returned by parse_newick"""
+        self.feed(b"", final=True)
+        if len(self.path) != 1:
+            raise ValueError("Unbalanced parentheses in Newick string")
+        parent = np.concatenate(self.parents)
+        labels = np.full(self.num_nodes, None, dtype=object)
+        if self.labels:
+            labels[np.concatenate(self.label_nodes)] = self.labels
+        edge_length = np.full(self.num_nodes, np.nan)
+        if self.length_nodes:
+            edge_length[np.concatenate(self.length_nodes)] = np.concatenate(
+                self.lengths)
+        return parent, labels.tolist(), edge_length
+
+
+def read_newick(newick_file, chunk_size=CHUNK_SIZE):
+    """Parse a Newick file (gzipped if its name contains "gz") a chunk at a
+    time, returning (parent, labels, edge_length)"""
+    parser = NewickStreamParser()
+    opener = gzip.open if "gz" in newick_file else open
+    with opener(newick_file, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            parser.feed(chunk)
+    return parser.result()
@@ -1,23 +1,10 @@
 #python usher_to_taxonium.py --input public-latest.all.masked.pb.gz --output ../taxonium_web_client/public/public2.jsonl.gz --metadata public-latest.metadata.tsv.gz --genbank hu1.gb --columns genbank_accession,country,date,pangolin_lineage
 
-from ftplib import all_errors
-import orjson
-import json
-import pandas as pd
-from alive_progress import config_handler, alive_it, alive_bar
-import datetime
-
-from . import ushertools
 from . import utils
+from . import newick
+from . import pipeline
+from .arraytree import ArrayTree
 import argparse
-import gzip
-
-import treeswift
-try:
-    from . import _version
-    version = _version.version
-except ImportError:
-    version = "dev"
 
 
 def do_processing(input_file,
@@ -30,6 +17,7 @@ def do_processing(input_file,
                   chronumental_date_output=None,
                   chronumental_tree_output=None,
                   chronumental_reference_node=None,
+                  chronumental_add_inferred_date=None,
                   config_file=None,
                   title=None,
                   overlay_html=None,
@@ -39,88 +27,47 @@ def do_processing(input_file,
                   shear=False,
                   shear_threshold=1000,
                   only_variable_sites=False,
-                  key_column="strain"):
-
-    metadata_dict, metadata_cols = utils.read_metadata(metadata_file, columns,
-                                                       key_column)
-
-    if config_file is not None:
-        config = json.load(open(config_file))
-    else:
-        config = {}
-
-    if title is not None:
-        config['title'] = title
-
-    if overlay_html is not None:
-        html_content = open(overlay_html).read()
-        config['overlay'] = html_content
-
-    if "gz" in input_file:
-        f = gzip.open(input_file, 'rt')
-    else:
-        f = open(input_file, 'rt')
-
-    # get all comtents
-    all_contents = f.read()
-    # remove line breaks
-    all_contents = all_contents.replace("\n", "")
-    # remove spaces
-    all_contents = all_contents.replace(" ", "")
-
-    tree = treeswift.read_tree_newick(all_contents)
-
-    print("Ladderizing tree..")
-    tree.ladderize(ascending=False)
-    print("Ladderizing done")
-
-    for node in tree.traverse_postorder():
-        if node.is_leaf():
-            node.num_tips = 1
-        else:
-            node.num_tips = sum(child.num_tips for child in node.children)
-    total_tips = tree.root.num_tips
-    utils.set_x_coords(tree.root, chronumental_enabled=False)
-    utils.set_terminal_y_coords(tree.root)
-    utils.set_internal_y_coords(tree.root)
-
-    nodes_sorted_by_y = utils.sort_on_y(tree)
-
-    config['num_tips'] = total_tips
-    yyyymmdd = datetime.datetime.now().strftime("%Y-%m-%d")
-    config['date_created'] = yyyymmdd
-
-    first_json = {
-        "version": version,
-        "mutations": [],
-        "total_nodes": len(nodes_sorted_by_y),
-        "config": config
-    }
-
-    node_to_index = {node: i for i, node in enumerate(nodes_sorted_by_y)}
-
-    if "gz" in output_file:
-        output_file = gzip.open(output_file, 'wb')
-    else:
-        output_file = open(output_file, 'wb')
-    output_file.write(orjson.dumps(first_json) + b"\n")
-    for node in alive_it(
-            nodes_sorted_by_y,
-            title="Converting each node, and writing out in JSON"):
-        node_object = utils.get_node_object(
-            node,
-            node_to_index,
-            metadata_dict, {},
-            metadata_cols,
-            chronumental_enabled=chronumental_enabled)
-        if remove_after_pipe and 'name' in node_object and node_object['name']:
-            node_object['name'] = node_object['name'].split("|")[0]
-        output_file.write(orjson.dumps(node_object) + b"\n")
-    output_file.close()
-
-    print(
-        f"Done. Output written to {output_file.name}, with {len(nodes_sorted_by_y)} nodes."
-    )
+                  key_column="strain",
+                  output_format="jsonl",
+                  compression_threads=1,
+                  compression_level=9):
+
+    config = pipeline.get_config(config_file, title, overlay_html)
+
+    print("Reading tree")
+    tree = ArrayTree(*newick.read_newick(input_file))
+
+    # Only metadata for names in the tree is kept
+    names = utils.get_tree_names(tree)
+    metadata, metadata_cols = utils.read_metadata(metadata_file,
+                                                  columns,
+                                                  key_column,
+                                                  keys=names)
+
+    if chronumental_enabled:
+        utils.do_chronumental(
+            tree=tree,
+            chronumental_reference_node=chronumental_reference_node,
+            metadata_file=metadata_file,
+            chronumental_steps=chronumental_steps,
+            chronumental_date_output=chronumental_date_output,
+            chronumental_tree_output=chronumental_tree_output,
+            chronumental_add_inferred_date=chronumental_add_inferred_date,
+            metadata=metadata,
+            metadata_cols=metadata_cols,
+            key_column=key_column)
+
+    tree.columns["num_tips"] = tree.compute_num_tips()
+    pipeline.write_tree(tree,
+                        output_file,
+                        config,
+                        metadata,
+                        metadata_cols,
+                        chronumental_enabled=chronumental_enabled,
+                        remove_after_pipe=remove_after_pipe,
+                        output_format=output_format,
+                        compression_threads=compression_threads,
+                        compression_level=compression_level)
 
 
 def get_parser():
@@ -148,7 +95,40 @@ def get_parser():
         help=
         "Column names to include in the metadata, separated by commas, e.g. `pangolin_lineage,country`"
     )
-
+    parser.add_argument(
+        '-C',
+        '--chronumental',
+        action='store_true',
+        help=
+        'Runs Chronumental to build a time tree. The metadata TSV must include a date column.'
+    )
+    parser.add_argument('--chronumental_steps',
+                        type=int,
+                        help='Number of steps to run Chronumental for')
+    parser.add_argument(
+        "--chronumental_date_output",
+        type=str,
+        help=
+        "Optional output file for the chronumental date table if you want to keep it (a table mapping nodes to their inferred dates)."
+    )
+    parser.add_argument(
+        "--chronumental_tree_output",
+        type=str,
+        help=
+        "Optional output file for the chronumental time tree file in nwk format."
+    )
+    parser.add_argument(
+        "--chronumental_reference_node",
+        type=str,
+        help=
+        "A reference node to be used for Chronumental. This should be earlier in the outbreak and have a good defined date. If not set the oldest sample will be automatically picked by Chronumental.",
+        default=None)
+    parser.add_argument(
+        "--chronumental_add_inferred_date",
+        type=str,
+        help=
+        "A new metadata-column-like name to be added for display with the value of Chronumental's inferred date for each sample.",
+        default=None)
     parser.add_argument(
         '-j',
         "--config_json",
@@ -176,6 +156,26 @@ def get_parser():
         help=
         "The column in the metadata file which is the same as the names in the tree",
         default="strain")
+    parser.add_argument(
+        '--remove_after_pipe',
+        action='store_true',
+        help=
+        'If set, we will remove anything after a pipe (|) in each node\'s name, after joining to metadata'
+    )
+    parser.add_argument(
+        "--compression_threads",
+        type=int,
+        help=
+        "Number of threads to compress gzipped jsonl output with. With more than one, the output is written as independently compressed blocks (like pigz), which any gzip reader can read.",
+        default=1)
+    parser.add_argument(
+        "--compression_level",
+        type=int,
+        choices=range(1, 10),
+        metavar="{1-9}",
+        help=
+        "gzip compression level for jsonl output, from 1 (fastest) to 9 (smallest)",
+        default=9)
 
     return parser
 
@@ -184,14 +184,24 @@ def main():
     parser = get_parser()
 
     args = parser.parse_args()
-    do_processing(args.input,
-                  args.output,
-                  metadata_file=args.metadata,
-                  columns=args.columns,
-                  config_file=args.config_json,
-                  title=args.title,
-                  overlay_html=args.overlay_html,
-                  key_column=args.key_column)
+    do_processing(
+        args.input,
+        args.output,
+        metadata_file=args.metadata,
+        columns=args.columns,
+        chronumental_enabled=args.chronumental,
+        chronumental_steps=args.chronumental_steps,
+        chronumental_date_output=args.chronumental_date_output,
+        chronumental_tree_output=args.chronumental_tree_output,
+        chronumental_reference_node=args.chronumental_reference_node,
+        chronumental_add_inferred_date=args.chronumental_add_inferred_date,
+        config_file=args.config_json,
+        title=args.title,
+        overlay_html=args.overlay_html,
+        key_column=args.key_column,
+        remove_after_pipe=args.remove_after_pipe,
+        compression_threads=args.compression_threads,
+        compression_level=args.compression_level)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,74 @@
+"""Gzip output compressed on several threads.
+
+Like ``pigz --independent``, the data is split into blocks and each block is
+compressed as its own gzip member. Concatenated members are a valid gzip
+file, which gunzip, zlib (and so Node's createGunzip) and Python's gzip module
+read back as a single stream. zlib releases the GIL while compressing, so the
+blocks are compressed in parallel by a thread pool while the caller carries on
+producing data.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+
+BLOCK_SIZE = 1 << 22
+
+
+class ParallelGzipWriter:
+    """Binary, write-only file object for a gzip file"""
+
+    def __init__(self,
+                 filename,
+                 threads,
+                 compresslevel=9,
+                 block_size=BLOCK_SIZE):
+        self.name = filename
+        self.file = open(filename, 'wb')
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        # Compressed blocks are written in order, with at most a couple of
+        # blocks per thread held in memory
+        self.pending = deque()
+        self.max_pending = 2 * threads
+
+    def _compress(self, block):
+        return gzip.compress(block, compresslevel=self.compresslevel, mtime=0)
+
+    def _submit(self):
+        block = bytes(self.buffer)
+        self.buffer.clear()
+        self.pending.append(self.executor.submit(self._compress, block))
+        while len(self.pending) > self.max_pending:
+            self.file.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.block_size:
+            self._submit()
+        return len(data)
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.buffer or not self.pending:
+            self._submit()
+        while self.pending:
+            self.file.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_gzip(filename, threads=1, compresslevel=9):
+    """A binary gzip file object for writing, compressed on the given number
+    of threads"""
+    if threads > 1:
+        return ParallelGzipWriter(filename, threads, compresslevel)
+    return gzip.open(filename, 'wb', compresslevel=compresslevel)
@@ -0,0 +1,88 @@
+"""Conversion steps shared by usher_to_taxonium and newick_to_taxonium.
+
+Once a converter has built its ArrayTree and read the metadata, the tree is
+ladderized, laid out, sorted on y and written out here, so both converters
+get the same output options.
+"""
+import datetime
+import json
+
+from . import layout
+from . import utils
+
+try:
+    from . import _version
+    version = _version.version
+except ImportError:
+    version = "dev"
+
+
+def get_config(config_file=None, title=None, overlay_html=None):
+    """The config for the header, from a JSON file and the title and overlay
+    options"""
+    if config_file is not None:
+        config = json.load(open(config_file))
+    else:
+        config = {}
+
+    if title is not None:
+        config['title'] = title
+
+    if overlay_html is not None:
+        html_content = open(overlay_html).read()
+        config['overlay'] = html_content
+    return config
+
+
+def write_tree(tree,
+               output_file,
+               config,
+               metadata,
+               metadata_cols,
+               chronumental_enabled=False,
+               remove_after_pipe=False,
+               output_format="jsonl",
+               compression_threads=1,
+               compression_level=9,
+               extra_header=None):
+    """Lay out the tree and write it and its metadata to output_file.
+
+    num_tips must already be set. extra_header holds any further header
+    entries, which go after the config."""
+    print("Ladderizing tree..")
+    tree.ladderize(ascending=False)
+    print("Ladderizing done")
+    layout.set_coords(tree, chronumental_enabled=chronumental_enabled)
+    order = utils.sort_on_y(tree)
+    mutation_objects, mutation_ids = utils.number_mutations(tree)
+
+    config['num_tips'] = int(tree.columns["num_tips"][0])
+    yyyymmdd = datetime.datetime.now().strftime("%Y-%m-%d")
+    config['date_created'] = yyyymmdd
+
+    first_json = {
+        "version": version,
+        "mutations": mutation_objects,
+        "total_nodes": len(order),
+        "config": config
+    }
+    first_json.update(extra_header or {})
+
+    writer = utils.open_output(output_file,
+                               first_json,
+                               output_format,
+                               metadata,
+                               compression_threads=compression_threads,
+                               compression_level=compression_level)
+    utils.write_nodes(writer,
+                      tree,
+                      order,
+                      metadata,
+                      mutation_ids,
+                      metadata_cols,
+                      chronumental_enabled=chronumental_enabled,
+                      remove_after_pipe=remove_after_pipe)
+    writer.close()
+
+    print(
+        f"Done. Output written to {writer.filename}, with {len(order)} nodes.")
@@ -0,0 +1,163 @@
+"""Incremental reader for serialized UShER ``parsimony.data`` protobufs.
+
+Instead of reading the whole (decompressed) file into memory and then parsing
+it into one large message, the top-level fields are read from the stream one
+record at a time. Records of the repeated fields are parsed in modest batches
+and handed to a consumer, so only one batch is ever held as protobuf objects.
+"""
+from . import parsimony_pb2
+
+CHUNK_SIZE = 1 << 22
+BATCH_SIZE = 50000
+
+VARINT, FIXED64, LENGTH_DELIMITED, FIXED32 = 0, 1, 2, 5
+
+FIELD_NUMBERS = {
+    field.name: field.number
+    for field in parsimony_pb2.data.DESCRIPTOR.fields
+}
+
+
+def encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+class ProtobufStream:
+    """Buffered access to the bytes of a binary file object"""
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = b""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, n):
+        """Try to make at least n unread bytes available"""
+        if len(self.buf) - self.pos >= n or self.eof:
+            return
+        parts = [self.buf[self.pos:]]
+        available = len(parts[0])
+        while available < n:
+            chunk = self.f.read(max(self.chunk_size, n - available))
+            if not chunk:
+                self.eof = True
+                break
+            parts.append(chunk)
+            available += len(chunk)
+        self.buf = b"".join(parts)
+        self.pos = 0
+
+    def at_end(self):
+        self._fill(1)
+        return self.pos >= len(self.buf)
+
+    def read_varint(self):
+        self._fill(10)
+        buf = self.buf
+        pos = self.pos
+        result = 0
+        shift = 0
+        while True:
+            if pos >= len(buf):
+                raise ValueError("Truncated varint in protobuf stream")
+            byte = buf[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        self.pos = pos
+        return result
+
+    def read_bytes(self, n):
+        if len(self.buf) - self.pos >= n:
+            out = self.buf[self.pos:self.pos + n]
+            self.pos += n
+            return out
+        # Large payloads (e.g. the newick string) are read directly rather
+        # than being appended to the buffer
+        parts = [self.buf[self.pos:]]
+        remaining = n - len(parts[0])
+        self.buf = b""
+        self.pos = 0
+        while remaining > 0:
+            chunk = self.f.read(remaining)
+            if not chunk:
+                raise ValueError("Truncated field in protobuf stream")
+            parts.append(chunk)
+            remaining -= len(chunk)
+        return b"".join(parts)
+
+    def skip_value(self, wire_type):
+        if wire_type == VARINT:
+            self.read_varint()
+        elif wire_type == FIXED64:
+            self.read_bytes(8)
+        elif wire_type == LENGTH_DELIMITED:
+            self.read_bytes(self.read_varint())
+        elif wire_type == FIXED32:
+            self.read_bytes(4)
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+
+
+def read_data(f,
+              node_mutations=None,
+              condensed_nodes=None,
+              metadata=None,
+              batch_size=BATCH_SIZE):
+    """Read a serialized parsimony.data message from the file object f.
+
+    node_mutations, condensed_nodes and metadata are optional consumers. Each
+    is called, in file order, with successive batches of that field's parsed
+    messages; fields without a consumer are skipped. Returns the newick
+    field as bytes.
+    """
+    consumers = {
+        FIELD_NUMBERS[name]: (name, consumer)
+        for name, consumer in (("node_mutations", node_mutations),
+                               ("condensed_nodes",
+                                condensed_nodes), ("metadata", metadata))
+        if consumer
+    }
+    stream = ProtobufStream(f)
+    newick = b""
+    batch = bytearray()
+    batch_field = None
+    batch_count = 0
+
+    def flush():
+        if batch_count:
+            name, consumer = consumers[batch_field]
+            message = parsimony_pb2.data()
+            message.MergeFromString(bytes(batch))
+            consumer(getattr(message, name))
+        batch.clear()
+
+    while not stream.at_end():
+        tag = stream.read_varint()
+        number, wire_type = tag >> 3, tag & 7
+        if wire_type != LENGTH_DELIMITED or (number not in consumers and number
+                                             != FIELD_NUMBERS["newick"]):
+            stream.skip_value(wire_type)
+            continue
+        length = stream.read_varint()
+        if number == FIELD_NUMBERS["newick"]:
+            newick = stream.read_bytes(length)
+            continue
+        if number != batch_field or batch_count >= batch_size:
+            flush()
+            batch_field = number
+            batch_count = 0
+        batch += encode_varint(tag)
+        batch += encode_varint(length)
+        batch += stream.read_bytes(length)
+        batch_count += 1
+    flush()
+    return newick
@@ -0,0 +1,274 @@
+"""Time trees from Chronumental, fitted in-process on the tree's arrays.
+
+Rather than writing the tree out as Newick, running the chronumental command
+and reading its time tree back, Chronumental's model is given the branch
+lengths and tip dates as arrays indexed by node, and the branch lengths in
+days come back in the same order. The model, its settings and the way the
+reference tip is chosen are those of the chronumental command's defaults.
+
+This relies on Chronumental's internals (its date parser, sparse matrix
+helper, model constructor and parameter names, and the defaults below), so
+it is only done with the version it was written against, which ``pip install
+taxoniumtools[chronumental]`` installs. With any other version, the
+chronumental command is run on the tree written out as Newick instead.
+"""
+import contextlib
+import importlib.metadata
+import os
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+import pandas as pd
+from alive_progress import alive_bar
+
+from . import layout
+from . import newick
+
+# The chronumental command's defaults in CHRONUMENTAL_VERSION
+MODEL = "DeltaGuideWithStrictLearntClock"
+DEFAULT_STEPS = 20000
+LEARNING_RATE = 0.03
+MODEL_CONFIGURATION = {
+    "variance_dates": 0.3,
+    "expected_min_between_transmissions": 3,
+    "enforce_exact_clock": False,
+    "variance_on_clock_rate": False,
+    "initial_tau": 3.2,
+    "hs_scale": 86917549.587,
+    "fixed_tau": True
+}
+MICROSECONDS_PER_DAY = 86400 * 10**6
+# Keep in step with the chronumental extra in setup.cfg
+CHRONUMENTAL_VERSION = "0.0.65"
+
+
+def chronumental_command_is_available():
+    return shutil.which("chronumental") is not None
+
+
+def chronumental_version():
+    try:
+        return importlib.metadata.version("chronumental")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def default_date_output(metadata_file):
+    """Where the chronumental command writes its dates table by default:
+    next to the metadata file, prefixed with "chronumental_dates" """
+    directory, name = os.path.split(metadata_file)
+    return os.path.join(directory, f"chronumental_dates_{name}.tsv")
+
+
+@contextlib.contextmanager
+def cpu_only():
+    """Hide any GPUs from CUDA, unless CUDA_VISIBLE_DEVICES is already set,
+    restoring the environment afterwards"""
+    if "CUDA_VISIBLE_DEVICES" in os.environ:
+        yield
+        return
+    os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+    try:
+        yield
+    finally:
+        del os.environ["CUDA_VISIBLE_DEVICES"]
+
+
+def parse_dates(values):
+    """Each of a column's distinct values as a datetime64 (NaT if it isn't a
+    usable date) and its uncertainty in days, read as Chronumental reads
+    dates"""
+    from chronumental import input_mod
+    parsed = [input_mod.get_datetime_and_error(value) for value in values]
+    dates = np.array(
+        [np.datetime64("NaT") if date is None else date for date, _ in parsed],
+        dtype="datetime64[us]")
+    errors = np.array(
+        [np.nan if error is None else error for _, error in parsed],
+        dtype=np.float64)
+    return dates, errors
+
+
+def get_tip_dates(tree, metadata):
+    """The leaves with a usable date in the metadata's date column, and their
+    dates, uncertainties and metadata rows"""
+    leaves = np.flatnonzero(tree.is_leaf)
+    rows = metadata.lookup([tree.labels[i] for i in leaves.tolist()])
+    codes = metadata.column_codes("date", rows)
+    dates, errors = parse_dates(metadata.values["date"])
+    dated = codes >= 0
+    dated[dated] = ~np.isnat(dates[codes[dated]])
+    codes = codes[dated]
+    return leaves[dated], dates[codes], errors[codes], rows[dated]
+
+
+def get_reference(tree, leaves, dates, rows, reference_node=None):
+    """The position among the dated leaves of the reference tip: the one
+    named, or else the oldest, taking the first in the metadata on ties"""
+    if reference_node:
+        matches = np.flatnonzero(
+            [tree.labels[i] == reference_node for i in leaves.tolist()])
+        if len(matches) == 0:
+            raise ValueError(
+                f"The Chronumental reference node {reference_node} is not a tip with a date in the metadata"
+            )
+        return int(matches[0])
+    if len(leaves) == 0:
+        raise ValueError(
+            "Could not find a reference point on the tree. This probably means that the names on your tree don't match the names in the metadata file."
+        )
+    oldest = np.flatnonzero(dates == dates.min())
+    return int(oldest[np.argmin(rows[oldest])])
+
+
+def get_paths(tree, leaves):
+    """(rows, cols) of the ones in a sparse matrix with a row for each leaf,
+    marking the nodes on its path to the root"""
+    rows = []
+    cols = []
+    terminals = np.arange(len(leaves))
+    nodes = leaves
+    while len(nodes):
+        rows.append(terminals)
+        cols.append(nodes)
+        has_parent = tree.parent[nodes] >= 0
+        terminals = terminals[has_parent]
+        nodes = tree.parent[nodes[has_parent]]
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+def run_chronumental(tree, metadata, steps=DEFAULT_STEPS, reference_node=None):
+    """Fit Chronumental's model to the tree, with tip dates from the
+    metadata's date column.
+
+    Returns the time length of each node's branch in days, and the inferred
+    date of each node."""
+    if steps is None:
+        steps = DEFAULT_STEPS
+    import jax
+    # Like the chronumental command, run on the CPU. JAX chooses its backend
+    # when first used, so the setting is only needed until then
+    with cpu_only():
+        jax.devices()
+    import jax.numpy as jnp
+    import numpyro.optim as optim
+    from numpyro.infer import SVI, Trace_ELBO
+    from scipy import stats
+    from chronumental import helpers, models
+
+    leaves, dates, errors, rows = get_tip_dates(tree, metadata)
+    reference = get_reference(tree, leaves, dates, rows, reference_node)
+    lengths = np.nan_to_num(tree.columns["edge_length"])
+    reference_distance = layout.root_distances(tree,
+                                               lengths)[leaves[reference]]
+    origin_date = dates[reference]
+    print(
+        f"Using {tree.labels[leaves[reference]]}, with date: {origin_date} and distance from root {reference_distance} as an arbitrary reference point"
+    )
+    print(f"Found {len(leaves)} terminals with usable date metadata")
+
+    # Whole days since the reference date, as Chronumental targets
+    target_dates = (dates - origin_date).astype(
+        np.int64) // MICROSECONDS_PER_DAY
+    target_dates_array = jnp.asarray(target_dates.astype(np.float64))
+    target_errors_array = jnp.asarray(errors)
+    branch_distances_array = jnp.asarray(lengths)
+    path_rows, path_cols = get_paths(tree, leaves)
+    path_rows = jnp.asarray(path_rows)
+    path_cols = jnp.asarray(path_cols)
+
+    root_to_tip = helpers.do_branch_matmul(path_rows,
+                                           path_cols,
+                                           branch_distances_array,
+                                           final_size=len(leaves))
+    clock_rate = stats.linregress(target_dates_array, root_to_tip).slope * 365
+    print(f"Root to tip regression: got rate of: {clock_rate}")
+    if clock_rate < 0:
+        raise ValueError(
+            "Root-to-tip regression predicted a negative mutation rate, so Chronumental can't be run on this tree."
+        )
+    if clock_rate < 1:
+        raise ValueError(
+            "Root-to-tip regression predicted a mutation rate of less than 1 mutation per year, so Chronumental can't be run on this tree."
+        )
+
+    model = models.models[MODEL](
+        rows=path_rows,
+        cols=path_cols,
+        branch_distances_array=branch_distances_array,
+        terminal_target_dates_array=target_dates_array,
+        terminal_target_errors_array=target_errors_array,
+        ref_point_distance=reference_distance,
+        model_configuration=dict(MODEL_CONFIGURATION, clock_rate=clock_rate),
+        terminal_names=[tree.labels[i] for i in leaves.tolist()])
+    svi = SVI(model.model, model.guide, optim.Adam(LEARNING_RATE),
+              Trace_ELBO())
+    state = svi.init(jax.random.PRNGKey(0))
+    lowest_loss = np.inf
+    best_params = None
+    with alive_bar(steps, title="Fitting time tree with Chronumental") as bar:
+        for step in range(steps):
+            state, loss = svi.update(state)
+            if loss < lowest_loss:
+                best_params = svi.get_params(state)
+                lowest_loss = loss
+            bar()
+    if best_params is None:
+        raise ValueError(
+            "Chronumental's fit failed: the loss was never finite")
+    print(f"Fit completed with loss {float(lowest_loss)}")
+
+    # As in the chronumental command, branch times are from the final step
+    # and the root date from the step with the lowest loss
+    time_length = np.asarray(model.get_branch_times(svi.get_params(state)),
+                             dtype=np.float64)
+    root_date = float(best_params["root_date_mu"])
+    days = layout.root_distances(tree, time_length, include_root=True)
+    offsets = np.round((days + root_date) * MICROSECONDS_PER_DAY)
+    node_dates = origin_date + offsets.astype("timedelta64[us]")
+    return time_length, node_dates
+
+
+def run_chronumental_command(tree,
+                             metadata_file,
+                             date_output,
+                             steps=None,
+                             reference_node=None):
+    """Run the chronumental command on the tree, with tip dates from the
+    metadata file, writing its dates table to date_output.
+
+    Returns the time length of each node's branch in days, and the names and
+    inferred dates in the dates table."""
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        distance_tree = os.path.join(tmpdirname, "distance_tree.nwk")
+        time_tree = os.path.join(tmpdirname, "timetree.nwk")
+        tree.write_tree_newick(distance_tree)
+        command = [
+            "chronumental", "--tree", distance_tree, "--dates", metadata_file,
+            "--tree_out", time_tree, "--dates_out", date_output
+        ]
+        if steps is not None:
+            command += ["--steps", str(steps)]
+        if reference_node:
+            command += ["--reference_node", reference_node]
+        if subprocess.run(command).returncode != 0:
+            raise RuntimeError("The chronumental command failed")
+        # The time tree has the same nodes, in the same order
+        parent, _, time_length = newick.read_newick(time_tree)
+    if len(parent) != tree.num_nodes():
+        raise ValueError(
+            "The time tree from chronumental doesn't match the input tree")
+    dates = pd.read_csv(date_output,
+                        sep="\t",
+                        dtype=str,
+                        keep_default_na=False,
+                        usecols=["strain", "predicted_date"])
+    return np.nan_to_num(time_length), dates["strain"].tolist(
+    ), dates["predicted_date"].tolist()
+
+
+def format_dates(dates):
+    """Dates as strings, formatted as pandas writes them to a table"""
+    return pd.Series(dates).astype(str).tolist()
@@ -1,22 +1,11 @@
 #python usher_to_taxonium.py --input public-latest.all.masked.pb.gz --output ../taxonium_web_client/public/public2.jsonl.gz --metadata public-latest.metadata.tsv.gz --genbank hu1.gb --columns genbank_accession,country,date,pangolin_lineage
 
-import orjson
-import json
-import pandas as pd
-import datetime
-from alive_progress import config_handler, alive_it, alive_bar
-
 from . import ushertools
 from . import utils
+from . import pipeline
 import argparse
 import gzip
 
-try:
-    from . import _version
-    version = _version.version
-except ImportError:
-    version = "dev"
-
 
 def do_processing(input_file,
                   output_file,
@@ -38,22 +27,15 @@ def do_processing(input_file,
                   shear=False,
                   shear_threshold=1000,
                   only_variable_sites=False,
-                  key_column="strain"):
-
-    metadata_dict, metadata_cols = utils.read_metadata(metadata_file, columns,
-                                                       key_column)
-
-    if config_file is not None:
-        config = json.load(open(config_file))
-    else:
-        config = {}
-
-    if title is not None:
-        config['title'] = title
+                  compact_root_sequence=False,
+                  key_column="strain",
+                  threads=1,
+                  aa_cache=None,
+                  output_format="jsonl",
+                  compression_threads=1,
+                  compression_level=9):
 
-    if overlay_html is not None:
-        html_content = open(overlay_html).read()
-        config['overlay'] = html_content
+    config = pipeline.get_config(config_file, title, overlay_html)
 
     if "gz" in input_file:
         f = gzip.open(input_file, 'rb')
@@ -70,113 +52,54 @@ def do_processing(input_file,
         clade_types=clade_types,
         name_internal_nodes=name_internal_nodes,
         shear=shear,
-        shear_threshold=shear_threshold)
+        shear_threshold=shear_threshold,
+        threads=threads,
+        aa_cache_file=aa_cache,
+        only_variable_sites=only_variable_sites,
+        compact_root_sequence=compact_root_sequence)
     f.close()
 
+    # Only metadata for names in the tree is kept
+    names = utils.get_tree_names(mat.tree)
+    metadata, metadata_cols = utils.read_metadata(metadata_file,
+                                                  columns,
+                                                  key_column,
+                                                  keys=names)
+
     if hasattr(mat, "genes"):
         config['gene_details'] = mat.genes
 
     if chronumental_enabled:
         utils.do_chronumental(
-            mat=mat,
+            tree=mat.tree,
             chronumental_reference_node=chronumental_reference_node,
             metadata_file=metadata_file,
             chronumental_steps=chronumental_steps,
             chronumental_date_output=chronumental_date_output,
             chronumental_tree_output=chronumental_tree_output,
             chronumental_add_inferred_date=chronumental_add_inferred_date,
-            metadata_dict=metadata_dict,
-            metadata_cols=metadata_cols)
-
-    print("Ladderizing tree..")
-    mat.tree.ladderize(ascending=False)
-    print("Ladderizing done")
-    total_tips = mat.tree.root.num_tips
-    utils.set_x_coords(mat.tree.root,
-                       chronumental_enabled=chronumental_enabled)
-    utils.set_terminal_y_coords(mat.tree.root)
-    utils.set_internal_y_coords(mat.tree.root)
+            metadata=metadata,
+            metadata_cols=metadata_cols,
+            key_column=key_column)
 
-    nodes_sorted_by_y = utils.sort_on_y(mat.tree)
-    all_aa_muts_objects = utils.get_all_aa_muts(mat.tree.root)
-    if only_variable_sites:
-        variable_muts = [
-            x for x in all_aa_muts_objects if x.initial_aa != x.final_aa
-        ]
-        variable_sites = set(
-            (x.gene, x.one_indexed_codon) for x in variable_muts)
-        all_aa_muts_objects = [
-            x for x in all_aa_muts_objects
-            if (x.gene, x.one_indexed_codon) in variable_sites
-        ]
-        mat.tree.root.aa_muts = [
-            x for x in mat.tree.root.aa_muts
-            if (x.gene, x.one_indexed_codon) in variable_sites
-        ]
-    all_nuc_muts = utils.get_all_nuc_muts(mat.tree.root)
-    if only_variable_sites:
-        variable_muts = [
-            x for x in all_nuc_muts
-            if x.par_nuc != x.mut_nuc and x.par_nuc != "X"
-        ]
-        variable_sites = set(
-            (x.chromosome, x.one_indexed_position) for x in variable_muts)
-        all_nuc_muts = [
-            x for x in all_nuc_muts
-            if (x.chromosome, x.one_indexed_position) in variable_sites
-        ]
-        mat.tree.root.nuc_mutations = [
-            x for x in mat.tree.root.nuc_mutations
-            if (x.chromosome, x.one_indexed_position) in variable_sites
-        ]
-    all_mut_inputs = all_aa_muts_objects + all_nuc_muts
-    all_mut_objects = [
-        utils.make_aa_object(i, input_thing)
-        if input_thing.type == "aa" else utils.make_nuc_object(i, input_thing)
-        for i, input_thing in enumerate(all_mut_inputs)
-    ]
+    extra_header = {}
+    if compact_root_sequence and hasattr(mat, "root_sequence"):
+        # The root's nucleotides, which the importer expands into one
+        # mutation per site
+        extra_header["root_sequence"] = utils.get_root_sequence_segments(
+            mat.root_sequence, mat.variable_positions)
 
-    input_to_index = {
-        input_thing: i
-        for i, input_thing in enumerate(all_mut_inputs)
-    }
-
-    config['num_tips'] = total_tips
-    yyyymmdd = datetime.datetime.now().strftime("%Y-%m-%d")
-    config['date_created'] = yyyymmdd
-
-    first_json = {
-        "version": version,
-        "mutations": all_mut_objects,
-        "total_nodes": len(nodes_sorted_by_y),
-        "config": config
-    }
-
-    node_to_index = {node: i for i, node in enumerate(nodes_sorted_by_y)}
-
-    if "gz" in output_file:
-        output_file = gzip.open(output_file, 'wb')
-    else:
-        output_file = open(output_file, 'wb')
-    output_file.write(orjson.dumps(first_json) + b"\n")
-    for node in alive_it(
-            nodes_sorted_by_y,
-            title="Converting each node, and writing out in JSON"):
-        node_object = utils.get_node_object(
-            node,
-            node_to_index,
-            metadata_dict,
-            input_to_index,
-            metadata_cols,
-            chronumental_enabled=chronumental_enabled)
-        if remove_after_pipe and 'name' in node_object and node_object['name']:
-            node_object['name'] = node_object['name'].split("|")[0]
-        output_file.write(orjson.dumps(node_object) + b"\n")
-    output_file.close()
-
-    print(
-        f"Done. Output written to {output_file.name}, with {len(nodes_sorted_by_y)} nodes."
-    )
+    pipeline.write_tree(mat.tree,
+                        output_file,
+                        config,
+                        metadata,
+                        metadata_cols,
+                        chronumental_enabled=chronumental_enabled,
+                        remove_after_pipe=remove_after_pipe,
+                        output_format=output_format,
+                        compression_threads=compression_threads,
+                        compression_level=compression_level,
+                        extra_header=extra_header)
 
 
 def get_parser():
@@ -299,6 +222,12 @@ def get_parser():
         help=
         "Only store information about the root sequence at a particular position if there is variation at that position somewhere in the tree. This helps to speed up the loading of larger genomes such as MPXV."
     )
+    parser.add_argument(
+        '--compact_root_sequence',
+        action='store_true',
+        help=
+        "Record the root sequence in the header as a compact \"root_sequence\" entry, rather than as one mutation per site on the root node. This makes output files much smaller, but they can only be loaded by versions of Taxonium that understand this entry."
+    )
 
     parser.add_argument(
         "--key_column",
@@ -306,6 +235,32 @@ def get_parser():
         help=
         "The column in the metadata file which is the same as the names in the tree",
         default="strain")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help=
+        "Number of processes to use for amino acid annotation, which is split across ranges of the tree. Output is the same whatever the number.",
+        default=1)
+    parser.add_argument(
+        "--aa_cache",
+        type=str,
+        help=
+        "Optional cache file of amino acid annotations, to speed up that step when converting successive versions of a growing tree. If the file exists, amino acid mutations are reused for every node whose nucleotide mutations on the path from the root are unchanged, and the file is then rewritten for the new tree. Only amino acid annotation is cached: everything else, including the metadata join and writing the output, is redone in full. Has no effect without --genbank.",
+        default=None)
+    parser.add_argument(
+        "--compression_threads",
+        type=int,
+        help=
+        "Number of threads to compress gzipped jsonl output with. With more than one, the output is written as independently compressed blocks (like pigz), which any gzip reader can read.",
+        default=1)
+    parser.add_argument(
+        "--compression_level",
+        type=int,
+        choices=range(1, 10),
+        metavar="{1-9}",
+        help=
+        "gzip compression level for jsonl output, from 1 (fastest) to 9 (smallest)",
+        default=9)
 
     return parser
 
@@ -335,7 +290,12 @@ def main():
         shear=args.shear,
         shear_threshold=args.shear_threshold,
         only_variable_sites=args.only_variable_sites,
-        key_column=args.key_column)
+        compact_root_sequence=args.compact_root_sequence,
+        key_column=args.key_column,
+        threads=args.threads,
+        aa_cache=args.aa_cache,
+        compression_threads=args.compression_threads,
+        compression_level=args.compression_level)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,16 @@
-from concurrent.futures import thread
-from . import parsimony_pb2
-import treeswift
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import itertools
+import multiprocessing
+from . import newick
+from . import protobuf_stream
+from . import aa_cache
+from .arraytree import ArrayTree, RaggedColumn, gather_ranges
 from alive_progress import alive_it, alive_bar
 from Bio import SeqIO
 from typing import ClassVar
 
 from dataclasses import dataclass
-from collections import defaultdict
+import numpy as np
 
 
 def reverse_complement(input_string):
@@ -44,25 +48,6 @@ class Gene:
     end: int  # 0-indexed
 
 
-from dataclasses import dataclass
-
-
-@dataclass(eq=False)
-class Codon:
-    gene: Gene
-    codon_number: int  # zero-indexed
-    positions: dict  # zero-indexed positions e.g. {0:123,1:124,2:125}
-    strand: int
-
-    def __eq__(self, other):
-        if isinstance(other, Codon):
-            return self.gene == other.gene and self.codon_number == other.codon_number
-        return False
-
-    def __hash__(self):
-        return hash((self.gene, self.codon_number))
-
-
 def get_codon_table():
     bases = "TCAG"
     codons = [a + b + c for a in bases for b in bases for c in bases]
@@ -72,6 +57,28 @@ def get_codon_table():
 
 codon_table = get_codon_table()
 
+# Nucleotides are coded by their index in "TCAG", so that a codon's code is
+# 16 * first + 4 * second + third, indexing CODON_TRANSLATION. Anything else
+# gets UNKNOWN_NUC, and complementing a known base flips bit 1.
+CODON_BASES = "TCAG"
+UNKNOWN_NUC = 4
+NUC_CODE_TABLE = bytes(
+    CODON_BASES.index(chr(i)) if chr(i) in CODON_BASES else UNKNOWN_NUC
+    for i in range(256))
+CODON_TRANSLATION = np.frombuffer("".join(codon_table.values()).encode(),
+                                  dtype=np.uint8)
+UNKNOWN_AA = ord("X")
+
+# An amino acid mutation is packed into one integer from the id of its codon
+# in a CodonTable and the ASCII codes of its initial and final amino acids
+AA_CODON_SHIFT = 16
+AA_INITIAL_SHIFT = 8
+
+
+def encode_nucleotides(sequence):
+    return bytearray(
+        sequence.encode("ascii", "replace").translate(NUC_CODE_TABLE))
+
 
 def get_gene_name(cds, gene_records):
     """Returns gene if available, otherwise locus tag"""
@@ -99,86 +106,404 @@ def get_genes_dict(cdses, gene_records):
     return genes
 
 
-def get_mutations(past_nuc_muts_dict,
-                  new_nuc_mutations_here,
-                  seq,
-                  nuc_to_codon,
-                  disable_check_for_differences=False):
+class CodonTable:
+    """Every complete codon of every CDS, as dense arrays indexed by codon id.
+
+    positions holds each codon's three zero-indexed genome positions in
+    reading order, and gene indexes into gene_names. position_offsets and
+    position_codons map each genome position to the ids of the codons that
+    include it, in increasing order."""
+
+    def __init__(self, gene_names, gene, codon_number, positions, strand,
+                 genome_length):
+        self.gene_names = list(gene_names)
+        self.gene = np.asarray(gene, dtype=np.int32)
+        self.codon_number = np.asarray(codon_number, dtype=np.int64)
+        self.positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        self.strand = np.asarray(strand, dtype=np.int8)
+
+        num_codons = len(self.gene)
+        stride = max(num_codons, 1)
+        pairs = np.unique(self.positions.ravel() * stride +
+                          np.repeat(np.arange(num_codons), 3))
+        position, self.position_codons = np.divmod(pairs, stride)
+        counts = np.bincount(position,
+                             minlength=max(genome_length,
+                                           int(position.max(initial=-1)) + 1))
+        self.position_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.position_offsets[1:])
+
+        # Lists are faster than arrays to index one item at a time
+        self._offsets = self.position_offsets.tolist()
+        self._position_codons = self.position_codons.tolist()
+        self._first, self._second, self._third = self.positions.T.tolist()
+        self._reverse = (self.strand == -1).tolist()
+        self._translation = CODON_TRANSLATION.tolist()
+        self._seen = [0] * num_codons
+        self._calls = 0
+
+    def __len__(self):
+        return len(self.gene)
+
+    def find(self, gene_names, codon_numbers):
+        """Ids of the codons with the given gene names and zero-indexed codon
+        numbers"""
+        gene_index = {name: i for i, name in enumerate(self.gene_names)}
+        genes = np.array([gene_index[x] for x in gene_names], dtype=np.int64)
+        # Each gene's codons are stored together, in order
+        gene_starts = np.searchsorted(self.gene, np.arange(len(gene_index)))
+        return gene_starts[genes] + np.asarray(codon_numbers, dtype=np.int64)
+
+    @staticmethod
+    def pack_mutations(codon, initial_aa, final_aa):
+        """Amino acid mutations packed as integers, from arrays of codon ids
+        and ASCII codes"""
+        return (np.asarray(codon, dtype=np.int64) << AA_CODON_SHIFT
+                | np.asarray(initial_aa, dtype=np.int64) << AA_INITIAL_SHIFT
+                | np.asarray(final_aa, dtype=np.int64))
+
+    @staticmethod
+    def unpack_mutations(packed):
+        """Codon ids, initial and final amino acid codes of packed mutations"""
+        return (packed >> AA_CODON_SHIFT, (packed >> AA_INITIAL_SHIFT) & 255,
+                packed & 255)
+
+    def translate(self, genome, codon):
+        """ASCII code of the amino acid the codon has in genome"""
+        a = genome[self._first[codon]]
+        b = genome[self._second[codon]]
+        c = genome[self._third[codon]]
+        if a == UNKNOWN_NUC or b == UNKNOWN_NUC or c == UNKNOWN_NUC:
+            return UNKNOWN_AA
+        if self._reverse[codon]:
+            a, b, c = a ^ 2, b ^ 2, c ^ 2
+        return self._translation[a * 16 + b * 4 + c]
+
+    def get_mutations(self,
+                      genome,
+                      positions,
+                      nucleotides,
+                      disable_check_for_differences=False):
+        """Set genome[positions] to the coded nucleotides, returning the
+        amino acid mutations this causes, packed as integers (see
+        AAMutationTable)"""
+        offsets, position_codons, seen = (self._offsets, self._position_codons,
+                                          self._seen)
+        self._calls += 1
+        call = self._calls
+        affected = []
+        for position in positions:
+            if position >= len(offsets) - 1:
+                continue
+            for codon in position_codons[offsets[position]:offsets[position +
+                                                                   1]]:
+                if seen[codon] != call:
+                    seen[codon] = call
+                    affected.append(codon)
+        initial = [self.translate(genome, codon) for codon in affected]
+
+        for position, nucleotide in zip(positions, nucleotides):
+            genome[position] = nucleotide
+
+        mutations_here = []
+        for codon, initial_aa in zip(affected, initial):
+            final_aa = self.translate(genome, codon)
+            if initial_aa != final_aa or disable_check_for_differences:
+                mutations_here.append(codon << AA_CODON_SHIFT
+                                      | initial_aa << AA_INITIAL_SHIFT
+                                      | final_aa)
+        return mutations_here
+
+
+@dataclass
+class MutationAnalysis:
+    """Everything needed to work out the amino acid mutations of any range of
+    nodes (in preorder), so that ranges can be processed independently.
+
+    Arrays are only read. Where processes can be forked, workers are forked
+    from the parent and share them copy-on-write; otherwise (e.g. on
+    Windows) the analysis is pickled and sent to each worker once."""
+    parent: np.ndarray
+    offsets: np.ndarray  # into ids, per node
+    ids: np.ndarray  # nucleotide mutation ids
+    positions: np.ndarray  # zero-indexed, per mutation id
+    nucleotides: np.ndarray  # coded, per mutation id
+    reference: bytearray  # coded reference genome
+    codons: CodonTable
+    skip: np.ndarray = None  # nodes whose subtrees need no annotation
+    subtree_sizes: np.ndarray = None
+
+    def run(self, start, stop, pbar=None):
+        """Packed amino acid mutations of nodes start to stop - 1, in one
+        preorder pass.
+
+        A single genome holds the sequence at the current node. Each node's
+        mutations are applied to it on entering the node, and undone once the
+        traversal has left the node's subtree. The mutations of the first
+        node's ancestors are applied up front, just as they would have been
+        on the way down to it. Skipped subtrees are left as None."""
+        positions = self.positions.tolist()
+        nucleotides = self.nucleotides.tolist()
+        codons = self.codons
+        genome = bytearray(self.reference)
+        path = []  # (node, [(position, previous nucleotide)]) pairs
+
+        def enter(node, ids_here):
+            positions_here = [positions[i] for i in ids_here]
+            path.append((node, [(position, genome[position])
+                                for position in positions_here]))
+            return positions_here, [nucleotides[i] for i in ids_here]
+
+        ancestors = []
+        node = int(self.parent[start]) if start < stop else -1
+        while node >= 0:
+            ancestors.append(node)
+            node = int(self.parent[node])
+        for node in reversed(ancestors):
+            ids_here = self.ids[self.offsets[node]:self.offsets[node + 1]]
+            for position, nucleotide in zip(*enter(node, ids_here.tolist())):
+                genome[position] = nucleotide
+
+        parent = self.parent[start:stop].tolist()
+        offsets = (self.offsets[start:stop + 1] - self.offsets[start]).tolist()
+        ids = self.ids[self.offsets[start]:self.offsets[stop]].tolist()
+        if self.skip is None:
+            skip_sizes = [0] * (stop - start)
+        else:
+            skip_sizes = np.where(self.skip[start:stop],
+                                  self.subtree_sizes[start:stop], 0).tolist()
+        aa_muts = [None] * (stop - start)
+        i = 0
+        while i < stop - start:
+            if skip_sizes[i]:
+                # The whole subtree is already annotated
+                if pbar:
+                    pbar(min(skip_sizes[i], stop - start - i))
+                i += skip_sizes[i]
+                continue
+            if pbar:
+                pbar()
+            while path and path[-1][0] != parent[i]:
+                for position, previous in reversed(path.pop()[1]):
+                    genome[position] = previous
+            positions_here, nucleotides_here = enter(
+                start + i, ids[offsets[i]:offsets[i + 1]])
+            aa_muts[i] = codons.get_mutations(genome, positions_here,
+                                              nucleotides_here)
+            i += 1
+        return aa_muts
+
+
+_mutation_analysis = None
+
+
+def _worker_context():
+    """A fork context where the platform has one, so workers inherit the
+    analysis instead of unpickling it, whatever the default start method"""
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return None
 
-    by_codon = defaultdict(list)
 
-    for mutation in new_nuc_mutations_here:
-        zero_indexed_pos = mutation.one_indexed_position - 1
-        if zero_indexed_pos in nuc_to_codon:
-            for codon in nuc_to_codon[zero_indexed_pos]:
-                by_codon[codon].append(mutation)
+def _init_mutation_analysis(mutation_analysis):
+    global _mutation_analysis
+    _mutation_analysis = mutation_analysis
 
-    mutations_here = []
-    for gene_codon, mutations in by_codon.items():
 
-        # For most of this function we ignore strand - so for negative strand we
-        # are actually collecting the complement of the codon
+def _run_mutation_analysis(start, stop):
+    return _mutation_analysis.run(start, stop)
 
-        initial_codon = [seq[gene_codon.positions[x]] for x in range(3)]
 
-        relevant_past_muts = [(x, past_nuc_muts_dict[x])
-                              for x in gene_codon.positions.values()
-                              if x in past_nuc_muts_dict]
-        flipped_dict = {
-            position: offset
-            for offset, position in gene_codon.positions.items()
-        }
-        for position, value in relevant_past_muts:
-            initial_codon[flipped_dict[position]] = value
+NUC_ENUM = "ACGT"
 
-        final_codon = initial_codon.copy()
 
+def pack_node_mutations(node_mutations):
+    """Decode a batch of UShER node_mutations messages into the number of
+    mutations on each node and every mutation packed into one integer, so that
+    identical mutations can be found with np.unique"""
+    counts = np.fromiter((len(x.mutation) for x in node_mutations),
+                         dtype=np.int64,
+                         count=len(node_mutations))
+    keys = np.fromiter((m.position << 4 | m.par_nuc << 2 | m.mut_nuc[0]
+                        for x in node_mutations for m in x.mutation),
+                       dtype=np.int64,
+                       count=int(counts.sum()))
+    return counts, keys
+
+
+class NucMutationTable:
+    """Distinct nucleotide mutations, each stored once and referred to by id.
+
+    position holds one-indexed positions, and par_nuc and mut_nuc hold codes
+    indexing into alphabet, which starts as UShER's nucleotide enum and is
+    extended if other characters are interned."""
+
+    def __init__(self, position, par_nuc, mut_nuc, alphabet=NUC_ENUM):
+        self.position = np.asarray(position, dtype=np.int64)
+        self.par_nuc = np.asarray(par_nuc, dtype=np.uint8)
+        self.mut_nuc = np.asarray(mut_nuc, dtype=np.uint8)
+        self.alphabet = list(alphabet)
+        self._objects = None
+        self._ids = None
+
+    @classmethod
+    def from_packed(cls, counts, keys):
+        """Build the table from per-node mutation counts and packed mutations
+        (see pack_node_mutations).
+
+        Returns the table and a RaggedColumn of each node's mutation ids."""
+        distinct, ids = np.unique(keys, return_inverse=True)
+        table = cls(distinct >> 4, (distinct >> 2) & 3, distinct & 3)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return table, RaggedColumn(offsets, ids.astype(np.int32), table)
+
+    def __len__(self):
+        return len(self.position)
+
+    def objects(self, ids):
+        if self._objects is None:
+            self._objects = [
+                NucMutation(one_indexed_position=position,
+                            par_nuc=self.alphabet[par_nuc],
+                            mut_nuc=self.alphabet[mut_nuc])
+                for position, par_nuc, mut_nuc in zip(self.position.tolist(
+                ), self.par_nuc.tolist(), self.mut_nuc.tolist())
+            ]
+        return [self._objects[i] for i in ids.tolist()]
+
+    def code(self, nuc):
+        if nuc not in self.alphabet:
+            self.alphabet.append(nuc)
+        return self.alphabet.index(nuc)
+
+    def intern(self, mutations):
+        """Ids for NucMutation objects, adding any not already in the table"""
+        if self._ids is None:
+            self._ids = {
+                mutation: i
+                for i, mutation in enumerate(self.objects(np.arange(len(
+                    self))))
+            }
+        new_mutations = []
+        ids = []
         for mutation in mutations:
-            pos_in_codon = flipped_dict[mutation.one_indexed_position - 1]
-            final_codon[pos_in_codon] = mutation.mut_nuc
-
-        initial_codon = "".join(initial_codon)
-        final_codon = "".join(final_codon)
-
-        if gene_codon.strand == -1:
-
-            initial_codon = complement(initial_codon)
-            final_codon = complement(final_codon)
-
-        initial_codon_trans = codon_table.get(initial_codon, 'X')
-        final_codon_trans = codon_table.get(final_codon, 'X')
-        if initial_codon_trans != final_codon_trans or disable_check_for_differences:
-            #(gene, codon_number + 1, initial_codon_trans, final_codon_trans)
-
-            mutations_here.append(
-                AAMutation(gene=gene_codon.gene,
-                           one_indexed_codon=gene_codon.codon_number + 1,
-                           initial_aa=initial_codon_trans,
-                           final_aa=final_codon_trans,
-                           nuc_for_codon=gene_codon.positions[1]))
-
-    # update past_nuc_muts_dict
-    for mutation in new_nuc_mutations_here:
-        past_nuc_muts_dict[mutation.one_indexed_position -
-                           1] = mutation.mut_nuc
-
-    return mutations_here
-
-
-def recursive_mutation_analysis(node, past_nuc_muts_dict, seq, cdses, pbar,
-                                nuc_to_codon):
-    pbar()
-
-    new_nuc_mutations_here = node.nuc_mutations
-    new_past_nuc_muts_dict = past_nuc_muts_dict.copy()
-    node.aa_muts = get_mutations(new_past_nuc_muts_dict,
-                                 new_nuc_mutations_here, seq, nuc_to_codon)
-    for child in node.children:
-        recursive_mutation_analysis(child, new_past_nuc_muts_dict, seq, cdses,
-                                    pbar, nuc_to_codon)
-
-
-NUC_ENUM = "ACGT"
+            if mutation not in self._ids:
+                self._ids[mutation] = len(self._objects)
+                self._objects.append(mutation)
+                new_mutations.append(mutation)
+            ids.append(self._ids[mutation])
+        if new_mutations:
+            self.position = np.concatenate([
+                self.position, [x.one_indexed_position for x in new_mutations]
+            ]).astype(np.int64)
+            self.par_nuc = np.concatenate([
+                self.par_nuc, [self.code(x.par_nuc) for x in new_mutations]
+            ]).astype(np.uint8)
+            self.mut_nuc = np.concatenate([
+                self.mut_nuc, [self.code(x.mut_nuc) for x in new_mutations]
+            ]).astype(np.uint8)
+        return np.array(ids, dtype=np.int32)
+
+
+class AAMutationTable:
+    """Distinct amino acid mutations, each stored once and referred to by id.
+
+    codon holds ids into codons, a CodonTable, and initial_aa and final_aa
+    hold ASCII codes. Mutations are found by their packed integer (see
+    CodonTable.get_mutations) rather than by hashing objects."""
+
+    def __init__(self, codons, codon, initial_aa, final_aa):
+        self.codons = codons
+        self.codon = np.asarray(codon, dtype=np.int64)
+        self.initial_aa = np.asarray(initial_aa, dtype=np.uint8)
+        self.final_aa = np.asarray(final_aa, dtype=np.uint8)
+        self._objects = None
+        self._ids = None
+
+    @classmethod
+    def from_packed(cls, codons, mutations):
+        """Build the table from each node's list of packed mutations.
+
+        Returns the table and a RaggedColumn of each node's mutation ids."""
+        counts = np.fromiter(map(len, mutations),
+                             dtype=np.int64,
+                             count=len(mutations))
+        keys = np.fromiter(itertools.chain.from_iterable(mutations),
+                           dtype=np.int64,
+                           count=int(counts.sum()))
+        distinct, ids = np.unique(keys, return_inverse=True)
+        table = cls(codons, *codons.unpack_mutations(distinct))
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return table, RaggedColumn(offsets, ids.astype(np.int32), table)
+
+    def __len__(self):
+        return len(self.codon)
+
+    @property
+    def gene(self):
+        """Index of each mutation's gene in codons.gene_names"""
+        return self.codons.gene[self.codon]
+
+    @property
+    def one_indexed_codon(self):
+        return self.codons.codon_number[self.codon] + 1
+
+    @property
+    def nuc_for_codon(self):
+        """Zero-indexed genome position of the middle of each codon"""
+        return self.codons.positions[self.codon, 1]
+
+    def packed(self):
+        return self.codons.pack_mutations(self.codon, self.initial_aa,
+                                          self.final_aa)
+
+    def objects(self, ids):
+        if self._objects is None:
+            gene_names = self.codons.gene_names
+            self._objects = [
+                AAMutation(gene=gene_names[gene],
+                           one_indexed_codon=codon,
+                           initial_aa=chr(initial_aa),
+                           final_aa=chr(final_aa),
+                           nuc_for_codon=nuc_for_codon)
+                for gene, codon, initial_aa, final_aa, nuc_for_codon in zip(
+                    self.gene.tolist(), self.one_indexed_codon.tolist(),
+                    self.initial_aa.tolist(), self.final_aa.tolist(),
+                    self.nuc_for_codon.tolist())
+            ]
+        return [self._objects[i] for i in ids.tolist()]
+
+    def intern(self, mutations):
+        """Ids for AAMutation objects, adding any not already in the table"""
+        if self._ids is None:
+            self._ids = {
+                key: i
+                for i, key in enumerate(self.packed().tolist())
+            }
+        codon = self.codons.find([x.gene for x in mutations],
+                                 [x.one_indexed_codon - 1 for x in mutations])
+        keys = self.codons.pack_mutations(
+            codon, [ord(x.initial_aa) for x in mutations],
+            [ord(x.final_aa) for x in mutations]).tolist()
+        new_keys = []
+        ids = []
+        for key in keys:
+            if key not in self._ids:
+                self._ids[key] = len(self._ids)
+                new_keys.append(key)
+            ids.append(self._ids[key])
+        if new_keys:
+            codon, initial_aa, final_aa = self.codons.unpack_mutations(
+                np.array(new_keys, dtype=np.int64))
+            self.codon = np.concatenate([self.codon, codon])
+            self.initial_aa = np.concatenate([self.initial_aa,
+                                              initial_aa]).astype(np.uint8)
+            self.final_aa = np.concatenate([self.final_aa,
+                                            final_aa]).astype(np.uint8)
+            self._objects = None
+        return np.array(ids, dtype=np.int32)
 
 
 def preorder_traversal(node):
@@ -228,19 +553,14 @@ class UsherMutationAnnotatedTree:
                  name_internal_nodes=False,
                  clade_types=[],
                  shear=False,
-                 shear_threshold=1000):
-        self.data = parsimony_pb2.data()
-        self.data.ParseFromString(tree_file.read())
-        self.condensed_nodes_dict = self.get_condensed_nodes_dict(
-            self.data.condensed_nodes)
-        print("Loading tree, this may take a while...")
-        self.tree = treeswift.read_tree(self.data.newick, schema="newick")
+                 shear_threshold=1000,
+                 threads=1,
+                 aa_cache_file=None,
+                 only_variable_sites=False,
+                 compact_root_sequence=False):
+        self.load_protobuf(tree_file, clade_types)
         if name_internal_nodes:
             self.name_internal_nodes()
-        self.data.newick = ''
-
-        self.annotate_mutations()
-        self.annotate_clades(clade_types)
 
         self.expand_condensed_nodes()
         self.assign_num_tips()
@@ -258,45 +578,160 @@ class UsherMutationAnnotatedTree:
         print(f"Tree to use now has {self.tree.root.num_tips} tips")
         self.set_branch_lengths()
         if genbank_file:
-            self.perform_aa_analysis()
-
-    def prune_node(self, node_to_prune):
+            self.perform_aa_analysis(threads, aa_cache_file,
+                                     only_variable_sites,
+                                     compact_root_sequence)
+        # One-indexed positions that some mutation changes, if only those
+        # are to be kept
+        self.variable_positions = None
+        if only_variable_sites:
+            self.keep_variable_sites()
+
+    def prune_node(self, node_to_prune, children, nuc_mutations, positions):
         """Remove node from parent, then check if parent has zero descendants. If so remove it.
         If parent has a single descendant, then give the parent's mutations to the descendant, unless they
         conflict with the descendants own mutations. Also give the parent's clade annotations to the descendant,
-        unless they conflict. Then prune the parent, and instead add this child to parent's parent."""
-        parent = node_to_prune.parent
-        parent.remove_child(node_to_prune)
-        if len(parent.children) == 0:
-            self.prune_node(parent)
-        elif len(parent.children) == 1:
-            child = parent.children[0]
-            for mutation in parent.nuc_mutations:
-                if mutation.one_indexed_position not in [
-                        x.one_indexed_position for x in child.nuc_mutations
-                ]:
-                    child.nuc_mutations.append(mutation)
-            if hasattr(parent, "clades"):
-                for clade_type, clade_annotation in parent.clades.items():
-                    if clade_type not in child.clades or child.clades[
-                            clade_type] == "":
-                        child.clades[clade_type] = clade_annotation
-            grandparent = parent.parent
-            parent.remove_child(child)
-            if grandparent:
-                grandparent.remove_child(parent)
-                grandparent.add_child(child)
+        unless they conflict. Then prune the parent, and instead add this child to parent's parent.
+
+        children holds an insertion-ordered dict of each node's children, so
+        that removing one is O(1)."""
+        tree = self.tree
+        parent = tree.parent[node_to_prune]
+        del children[parent][node_to_prune]
+        tree.parent[node_to_prune] = -1
+        # Removing a parent's last child removes the parent too, and so on up
+        while len(children[parent]) == 0 and tree.parent[parent] >= 0:
+            node_to_prune, parent = parent, tree.parent[parent]
+            del children[parent][node_to_prune]
+            tree.parent[node_to_prune] = -1
+        if len(children[parent]) == 1:
+            child = next(iter(children[parent]))
+            child_positions = {positions[x] for x in nuc_mutations[child]}
+            for mutation in nuc_mutations[parent]:
+                if positions[mutation] not in child_positions:
+                    nuc_mutations[child].append(mutation)
+                    child_positions.add(positions[mutation])
+            for clade_type, clade_annotations in tree.clades.items():
+                if clade_annotations[parent] is not None and (
+                        clade_annotations[child] is None
+                        or clade_annotations[child] == ""):
+                    clade_annotations[child] = clade_annotations[parent]
+            grandparent = tree.parent[parent]
+            del children[parent][child]
+            tree.parent[child] = -1
+            if grandparent >= 0:
+                del children[grandparent][parent]
+                tree.parent[parent] = -1
+                children[grandparent][child] = None
+                tree.parent[child] = grandparent
 
     def shear_tree(self, theshold=1000):
         """Consider each node. If at any point a child has fewer than 1/threshold proportion of the num_tips, then prune it"""
-        for node in alive_it(list(self.tree.traverse_postorder())):
-            if (node == self.tree.root):
+        tree = self.tree
+        num_tips = tree.columns["num_tips"].tolist()
+        children = [dict.fromkeys(x) for x in tree.children_lists()]
+        nuc_mutations = tree.ragged["nuc_mutations"].to_lists()
+        positions = self.nuc_mutation_table.position.tolist()
+        # First sweep: prune, keeping the structure in children and parent
+        for node in alive_it(tree.postorder().tolist()):
+            if node == 0:
                 continue
-            if len(node.children) > 1:
-                biggest_child = max(node.children, key=lambda x: x.num_tips)
-                for child in list(node.children):
-                    if biggest_child.num_tips / child.num_tips > theshold:
-                        self.prune_node(child)
+            if len(children[node]) > 1:
+                biggest_child = max(children[node], key=lambda x: num_tips[x])
+                for child in list(children[node]):
+                    if num_tips[biggest_child] / num_tips[child] > theshold:
+                        self.prune_node(child, children, nuc_mutations,
+                                        positions)
+        # Second sweep: rebuild the arrays from what is still attached
+        tree.ragged["nuc_mutations"] = RaggedColumn.from_lists(
+            nuc_mutations, np.int32, self.nuc_mutation_table)
+        tree.restructure(children)
+
+    def perform_aa_analysis(self,
+                            threads=1,
+                            aa_cache_file=None,
+                            only_variable_sites=False,
+                            compact_root_sequence=False):
+
+        seq = str(self.genbank.seq)
+        table = self.nuc_mutation_table
+        reference = encode_nucleotides(seq)
+        if len(table):
+            reference.extend([UNKNOWN_NUC] *
+                             (int(table.position.max()) - len(reference)))
+        alphabet_codes = np.frombuffer(encode_nucleotides("".join(
+            table.alphabet)),
+                                       dtype=np.uint8)
+        nuc_mutations = self.tree.ragged["nuc_mutations"]
+        mutation_analysis = MutationAnalysis(
+            parent=self.tree.parent,
+            offsets=nuc_mutations.offsets,
+            ids=nuc_mutations.values,
+            positions=table.position - 1,
+            nucleotides=alphabet_codes[table.mut_nuc],
+            reference=reference,
+            codons=self.codons)
+        num_nodes = self.tree.num_nodes()
+        aa_muts = [None] * num_nodes
+
+        cache = None
+        if aa_cache_file:
+            digest = aa_cache.reference_digest(seq, self.codons)
+            keys = aa_cache.node_keys(self.tree, table)
+            cache = aa_cache.AACache.load(aa_cache_file, digest)
+        if cache:
+            entries = cache.lookup(keys)
+            missing = self.tree.sum_up((entries < 0).astype(np.int64))
+            mutation_analysis.skip = missing == 0
+            mutation_analysis.subtree_sizes = self.tree.subtree_sizes()
+            print(
+                f"Reusing cached amino acid mutations for {np.count_nonzero(entries >= 0)} of {num_nodes} nodes"
+            )
+
+        with alive_bar(num_nodes, title="Annotating amino acids") as pbar:
+            if threads > 1:
+                # Many more ranges than processes, to balance the load
+                step = max(1, -(-num_nodes // (threads * 16)))
+                with ProcessPoolExecutor(
+                        threads,
+                        mp_context=_worker_context(),
+                        initializer=_init_mutation_analysis,
+                        initargs=(mutation_analysis, )) as executor:
+                    futures = {
+                        executor.submit(_run_mutation_analysis, start,
+                                        min(start + step, num_nodes)):
+                        start
+                        for start in range(0, num_nodes, step)
+                    }
+                    for future in as_completed(futures):
+                        result = future.result()
+                        start = futures[future]
+                        aa_muts[start:start + len(result)] = result
+                        pbar(len(result))
+            else:
+                aa_muts[:] = mutation_analysis.run(0, num_nodes, pbar)
+
+        if cache:
+            cached_mutations = cache.packed_rows(self.codons).tolist()
+            for node in np.flatnonzero(mutation_analysis.skip).tolist():
+                if aa_muts[node] is None:
+                    aa_muts[node] = [
+                        cached_mutations[x] for x in cache.get(entries[node])
+                    ]
+        if aa_cache_file:
+            aa_cache.AACache.save(aa_cache_file, digest, keys, aa_muts,
+                                  self.codons)
+
+        aa_muts[0] = self.get_root_aa_mutations(
+            seq, aa_muts[1:] if only_variable_sites else None)
+        self.aa_mutation_table, self.tree.ragged[
+            "aa_muts"] = AAMutationTable.from_packed(self.codons, aa_muts)
+        if compact_root_sequence:
+            # The root's nucleotides are recorded by root_sequence instead
+            self.tree.root.nuc_mutations = []
+        else:
+            root_muts = self.create_mutation_like_objects_to_record_root_seq()
+            self.tree.root.nuc_mutations = root_muts
 
     def create_mutation_like_objects_to_record_root_seq(self):
         """Hacky way of recording the root sequence"""
@@ -309,33 +744,54 @@ class UsherMutationAnnotatedTree:
 
         return ref_muts
 
-    def annotate_clades(self, clade_types):
-        if clade_types:
-            for i, node in alive_it(list(
-                    enumerate(preorder_traversal(self.tree.root))),
-                                    title="Annotating clades"):
-
-                this_thing = self.data.metadata[i]
-                node.clades = {
-                    clade_types[index]: part
-                    for index, part in enumerate(this_thing.clade_annotations)
-                }
-
-    def perform_aa_analysis(self):
-
-        seq = str(self.genbank.seq)
-        with alive_bar(self.tree.num_nodes(),
-                       title="Annotating amino acids") as pbar:
-            recursive_mutation_analysis(self.tree.root, {}, seq, self.cdses,
-                                        pbar, self.nuc_to_codon)
-        root_muts = self.create_mutation_like_objects_to_record_root_seq()
-        self.tree.root.aa_muts = get_mutations(
-            {},
-            root_muts,
-            seq,
-            self.nuc_to_codon,
-            disable_check_for_differences=True)
-        self.tree.root.nuc_mutations = root_muts
+    def get_root_aa_mutations(self, seq, node_aa_muts=None):
+        """The amino acid of every codon at the root, as mutations from the
+        reference. If the packed amino acid mutations of the other nodes are
+        given, only codons that change somewhere (on those nodes, or between
+        the reference and the root) are included."""
+        reference = encode_nucleotides(seq)
+        root = encode_nucleotides(self.root_sequence)
+        if node_aa_muts is None:
+            return self.codons.get_mutations(
+                reference,
+                range(len(root)),
+                root,
+                disable_check_for_differences=True)
+        root_codes = np.frombuffer(root, dtype=np.uint8)
+        differences = np.flatnonzero(
+            np.frombuffer(reference, dtype=np.uint8) != root_codes).tolist()
+        packed = np.fromiter(itertools.chain(
+            itertools.chain.from_iterable(node_aa_muts),
+            self.codons.get_mutations(bytearray(reference), differences,
+                                      [root[x] for x in differences])),
+                             dtype=np.int64)
+        variable = np.zeros(len(self.codons), dtype=bool)
+        variable[self.codons.unpack_mutations(packed)[0]] = True
+        positions = np.unique(self.codons.positions[variable])
+        # Other codons sharing these positions are dropped afterwards
+        mutations = np.array(self.codons.get_mutations(
+            reference,
+            positions.tolist(),
+            root_codes[positions].tolist(),
+            disable_check_for_differences=True),
+                             dtype=np.int64)
+        return mutations[variable[self.codons.unpack_mutations(mutations)
+                                  [0]]].tolist()
+
+    def keep_variable_sites(self):
+        """Find the positions that some nucleotide mutation changes, and drop
+        the root's mutations at any other positions"""
+        table = self.nuc_mutation_table
+        nuc_mutations = self.tree.ragged["nuc_mutations"]
+        ids = nuc_mutations.values
+        changed = table.par_nuc[ids] != table.mut_nuc[ids]
+        if "X" in table.alphabet:
+            changed &= table.par_nuc[ids] != table.alphabet.index("X")
+        self.variable_positions = np.unique(table.position[ids[changed]])
+        root_ids = nuc_mutations[0]
+        nuc_mutations.set(
+            0, root_ids[np.isin(table.position[root_ids],
+                                self.variable_positions)])
 
     def load_genbank_file(self, genbank_file):
         self.genbank = SeqIO.read(genbank_file, "genbank")
@@ -346,118 +802,178 @@ class UsherMutationAnnotatedTree:
 
         self.genes = get_genes_dict(self.cdses, gene_records)
 
-        by_everything = defaultdict(lambda: defaultdict(dict))
-        total_lengths = {}
-
+        # Zero-indexed genome positions of each gene's nucleotides, in
+        # reading order
+        by_gene = {}
         for feature in self.cdses:
 
             gene_name = get_gene_name(feature, gene_records)
-
-            nucleotide_counter = 0
-            for part in feature.location.parts:
-                ranger = range(
-                    part.start, part.end
-                ) if part.strand == 1 else range(
+            positions = np.concatenate([
+                np.arange(part.start, part.end)
+                if part.strand == 1 else np.arange(
                     part.end - 1, part.start - 1, -1
                 )  #(honestly not sure why we need to subtract 1 here but we seem to?)
-
-                for genome_position in ranger:
-
-                    cur_codon_number = nucleotide_counter // 3
-                    cur_pos_in_codon = nucleotide_counter % 3
-
-                    by_everything[gene_name][cur_codon_number][
-                        cur_pos_in_codon] = genome_position
-                    nucleotide_counter += 1
-            total_lengths[gene_name] = nucleotide_counter
-
-        nuc_to_codon = defaultdict(list)
-
-        for feat_name, codons in by_everything.items():
-            for codon_index, codon_dict in codons.items():
-                codon_obj = Codon(feat_name, codon_index, codon_dict,
-                                  self.genes[feat_name].strand)
-
-                if len(codon_dict) % 3 == 0:
-                    for k, v in codon_dict.items():
-                        nuc_to_codon[v].append(codon_obj)
-                else:
-                    print(f"Skipping partial codon for feature {feat_name}")
-
-        self.nuc_to_codon = nuc_to_codon
-
-    def convert_nuc_mutation(self, usher_mutation):
-        new_mut = NucMutation(one_indexed_position=usher_mutation.position,
-                              par_nuc=NUC_ENUM[usher_mutation.par_nuc],
-                              mut_nuc=NUC_ENUM[usher_mutation.mut_nuc[0]])
-        return new_mut
-
-    def annotate_mutations(self):
-        for i, node in alive_it(list(
-                enumerate(preorder_traversal(self.tree.root))),
-                                title="Annotating nuc muts"):
-            node.nuc_mutations = [
-                self.convert_nuc_mutation(x)
-                for x in self.data.node_mutations[i].mutation
-            ]
+                for part in feature.location.parts
+            ]).astype(np.int64)
+            previous = by_gene.get(gene_name)
+            # A later CDS with the same name overwrites the start of an
+            # earlier one
+            if previous is not None and len(previous) > len(positions):
+                positions = np.concatenate(
+                    [positions, previous[len(positions):]])
+            by_gene[gene_name] = positions
+
+        genes, codon_numbers, codon_positions = [], [], []
+        for gene_id, (feat_name, positions) in enumerate(by_gene.items()):
+            num_codons = len(positions) // 3
+            if len(positions) % 3:
+                print(f"Skipping partial codon for feature {feat_name}")
+            genes.append(np.full(num_codons, gene_id))
+            codon_numbers.append(np.arange(num_codons))
+            codon_positions.append(positions[:num_codons * 3])
+        strands = np.array(
+            [self.genes[feat_name].strand or 0 for feat_name in by_gene],
+            dtype=np.int8)
+        genes = np.concatenate(genes) if genes else np.zeros(0, np.int32)
+        self.codons = CodonTable(
+            by_gene, genes,
+            np.concatenate(codon_numbers) if codon_numbers else [],
+            np.concatenate(codon_positions) if codon_positions else [],
+            strands[genes], len(self.genbank.seq))
 
     def get_root_sequence(self):
-        collected_mutations = {}
-        for i, node in alive_it(list(
-                enumerate(self.tree.root.traverse_postorder())),
-                                title="Getting root sequence"):
-            if node == self.tree.root:
-                continue
-            for mutation in node.nuc_mutations:
-                collected_mutations[
-                    mutation.one_indexed_position] = mutation.par_nuc
-        self.root_sequence = list(str(self.genbank.seq))
-        for i, character in enumerate(self.root_sequence):
-            if i + 1 in collected_mutations:
-                self.root_sequence[i] = collected_mutations[i + 1]
-        self.root_sequence = "".join(self.root_sequence)
+        """Work back from the reference to the root, using the parental
+        nucleotide of the last mutation at each position in postorder"""
+        table = self.nuc_mutation_table
+        nuc_mutations = self.tree.ragged["nuc_mutations"]
+        order = self.tree.postorder()
+        ids = gather_ranges(nuc_mutations.offsets, order[order != 0],
+                            nuc_mutations.values)[::-1]
+        positions, last = np.unique(table.position[ids], return_index=True)
+        par_nucs = np.frombuffer("".join(table.alphabet).encode(),
+                                 dtype=np.uint8)[table.par_nuc[ids[last]]]
+        genome = bytearray(str(self.genbank.seq).encode())
+        in_genome = (positions >= 1) & (positions <= len(genome))
+        np.frombuffer(genome, dtype=np.uint8)[positions[in_genome] -
+                                              1] = par_nucs[in_genome]
+        self.root_sequence = genome.decode()
 
     def name_internal_nodes(self):
-        for i, node in alive_it(list(
-                enumerate(preorder_traversal_internal(self.tree.root))),
+        internal = np.flatnonzero(~self.tree.is_leaf)
+        if len(internal) == 0 or internal[0] != 0:
+            internal = np.concatenate([[0], internal])
+        labels = self.tree.labels
+        for i, node in alive_it(list(enumerate(internal.tolist())),
                                 title="Naming internal nodes"):
-            if not node.label:
-                node.label = "node_" + str(i + 1)
+            if not labels[node]:
+                labels[node] = "node_" + str(i + 1)
 
     def set_branch_lengths(self):
-        for node in alive_it(list(preorder_traversal(self.tree.root)),
-                             title="Setting branch length"):
-            node.edge_length = len(node.nuc_mutations)
+        self.tree.columns["edge_length"] = self.tree.ragged[
+            "nuc_mutations"].lengths().astype(np.float64)
 
     def expand_condensed_nodes(self):
-        for node in alive_it(list(self.tree.traverse_leaves()),
-                             title="Expanding condensed nodes"):
-
-            if node.label and node.label in self.condensed_nodes_dict:
-                assert len(node.nuc_mutations) == 0
-
-                for new_node_label in self.condensed_nodes_dict[node.label]:
-                    new_node = treeswift.Node(label=new_node_label)
-                    new_node.nuc_mutations = node.nuc_mutations
-                    if hasattr(node, "clades"):
-                        new_node.clades = node.clades
-                    node.parent.add_child(new_node)
-                node.label = ""
-                node.parent.remove_child(node)
-            else:
-                pass
+        """Replace each leaf named in condensed_nodes_dict with tips for the
+        samples it stands for, appended to the end of its parent's children.
+
+        Leaves are handled right-to-left, as treeswift's traverse_leaves
+        visits them, so each parent's new tips come in that order. Rather
+        than editing child lists, the expanded tree's preorder is worked out
+        directly: the new tips of a parent go just after its subtree, with
+        those of deeper parents first where subtrees end together."""
+        tree = self.tree
+        labels = tree.labels
+        condensed = [
+            node for node in tree.leaves()[::-1].tolist() if node != 0
+            and labels[node] and labels[node] in self.condensed_nodes_dict
+        ]
+        condensed = np.array(condensed, dtype=np.int64)
+        if len(condensed) == 0:
+            return
+        assert not np.any(tree.ragged["nuc_mutations"].lengths()[condensed]), (
+            "Condensed nodes should not have mutations")
+        members = [self.condensed_nodes_dict[labels[x]] for x in condensed]
+        counts = np.array([len(x) for x in members], dtype=np.int64)
+        num_nodes = tree.num_nodes()
+        subtree_ends = np.arange(num_nodes) + tree.subtree_sizes()
+        depths = tree.depths()
+        copy_from = np.repeat(condensed, counts)
+        new_parents = tree.parent[copy_from]
+        new_labels = [label for x in members for label in x]
+        new_nodes = np.array(tree.append_nodes(new_labels, copy_from),
+                             dtype=np.int64)
+
+        kept = np.ones(num_nodes, dtype=bool)
+        kept[condensed] = False
+        kept = np.flatnonzero(kept)
+        source = np.concatenate([kept, new_nodes])
+        order = source[np.lexsort((
+            source,
+            np.concatenate([np.zeros(len(kept)), -depths[new_parents]]),
+            np.concatenate([np.ones(len(kept)),
+                            np.zeros(len(new_nodes))]),
+            np.concatenate([kept, subtree_ends[new_parents]]),
+        ))]
+        old_parent = tree.parent.copy()
+        old_parent[new_nodes] = new_parents
+        new_index = np.full(tree.num_nodes() + 1, -1, dtype=np.int64)
+        new_index[order] = np.arange(len(order))
+        # The root's parent of -1 maps to the final entry, which stays -1
+        parent = new_index[old_parent[order]]
+        tree.reorder(order, parent)
+
+    def read_condensed_nodes(self, condensed_nodes):
+        for condensed_node in condensed_nodes:
+            self.condensed_nodes_dict[condensed_node.node_name] = list(
+                condensed_node.condensed_leaves)
+
+    def load_protobuf(self, tree_file, clade_types):
+        """Read the tree, its nucleotide mutations, condensed nodes and clade
+        annotations, decoding the protobuf field by field as it is streamed"""
+        self.condensed_nodes_dict = {}
+        clades = {clade_type: [] for clade_type in clade_types}
+        packed_mutations = []
+        with alive_bar(title="Reading protobuf") as bar:
+
+            def read_node_mutations(node_mutations):
+                packed_mutations.append(pack_node_mutations(node_mutations))
+                bar(len(node_mutations))
+
+            def read_metadata(metadata):
+                for this_thing in metadata:
+                    annotations = this_thing.clade_annotations
+                    for index, part in enumerate(annotations):
+                        clades[clade_types[index]].append(part)
+                    for clade_type in clade_types[len(annotations):]:
+                        clades[clade_type].append(None)
+
+            newick_string = protobuf_stream.read_data(
+                tree_file,
+                node_mutations=read_node_mutations,
+                condensed_nodes=self.read_condensed_nodes,
+                metadata=read_metadata if clade_types else None)
 
-    def get_condensed_nodes_dict(self, condensed_nodes_dict):
-        output_dict = {}
-        for condensed_node in alive_it(condensed_nodes_dict,
-                                       title="Reading condensed nodes dict"):
-            output_dict[
-                condensed_node.node_name] = condensed_node.condensed_leaves
-        return output_dict
+        print("Loading tree, this may take a while...")
+        self.tree = ArrayTree(*newick.parse_newick(newick_string))
+        del newick_string
+        num_nodes = self.tree.num_nodes()
+        counts = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                                [x[0] for x in packed_mutations])
+        keys = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                              [x[1] for x in packed_mutations])
+        packed_mutations.clear()
+        if num_nodes != len(counts):
+            raise ValueError(
+                f"Tree has {num_nodes} nodes but the protobuf has mutations for {len(counts)}"
+            )
+        self.nuc_mutation_table, self.tree.ragged[
+            "nuc_mutations"] = NucMutationTable.from_packed(counts, keys)
+        for clade_type, annotations in clades.items():
+            if len(annotations) != num_nodes:
+                raise ValueError(
+                    f"Tree has {num_nodes} nodes but the protobuf has clade annotations for {len(annotations)}"
+                )
+        self.tree.clades = clades
 
     def assign_num_tips(self):
-        for node in self.tree.traverse_postorder():
-            if node.is_leaf():
-                node.num_tips = 1
-            else:
-                node.num_tips = sum(child.num_tips for child in node.children)
+        self.tree.columns["num_tips"] = self.tree.compute_num_tips()
@@ -1,223 +1,201 @@
 from alive_progress import alive_it, alive_bar
 import pandas as pd
-import warnings
-import os, tempfile, sys, errno
-import treeswift
-import shutil
-from . import ushertools
-
-
-def read_metadata(metadata_file, columns, key_column):
-    must_have_cols = [key_column]
+import numpy as np
+import sys
+import itertools
+import orjson
+from . import columnar, parallel_gzip, timetree
+from .arraytree import gather_ranges
+from .metadata import MetadataTable, read_metadata_table
+
+
+def read_metadata(metadata_file, columns, key_column, keys=None):
+    """Returns a MetadataTable of the requested columns, and their names.
+    If keys is given, only rows with those keys are kept."""
     cols_of_interest = set(columns.split(",")) if columns else set()
-    cols_of_interest.update(must_have_cols)
-    cols_of_interest = list(cols_of_interest)
 
-    #only load these cols:
     if metadata_file:
         print("Loading metadata file..")
-        #Disable warnings because of DTypeWarning in pandas
-
-        warnings.filterwarnings("ignore")
-        metadata = pd.read_csv(metadata_file,
-                               sep="\t" if metadata_file.endswith(".tsv")
-                               or metadata_file.endswith(".tsv.gz") else ",",
-                               usecols=cols_of_interest)
-        # Enable again
-        warnings.filterwarnings("default")
-        metadata[key_column] = metadata[key_column].astype(str)
-        metadata.set_index(key_column, inplace=True)
-        # convert metadata to dict of rows
-        if not metadata.index.is_unique:
-            raise ValueError(
-                f"Error: The key column '{key_column}' contains non-unique values in the metadata file."
-            )
-
-        metadata_dict = metadata.to_dict("index")
-        metadata_cols = metadata.columns.tolist()
-        del metadata
+        metadata = read_metadata_table(metadata_file,
+                                       cols_of_interest,
+                                       key_column,
+                                       keys=keys)
         print("Metadata loaded")
-        return metadata_dict, metadata_cols
     else:
-        metadata_dict = {}
-        metadata_cols = []
-        return metadata_dict, metadata_cols
-
-
-def do_chronumental(mat, chronumental_reference_node, metadata_file,
-                    chronumental_steps, chronumental_date_output,
-                    chronumental_tree_output, chronumental_add_inferred_date,
-                    metadata_dict, metadata_cols):
-    chronumental_is_available = os.system(
-        "which chronumental > /dev/null") == 0
-    if not chronumental_is_available:
+        metadata = MetadataTable.empty()
+    return metadata, list(metadata.columns)
+
+
+def do_chronumental(tree,
+                    chronumental_reference_node,
+                    metadata_file,
+                    chronumental_steps,
+                    chronumental_date_output,
+                    chronumental_tree_output,
+                    chronumental_add_inferred_date,
+                    metadata,
+                    metadata_cols,
+                    key_column="strain"):
+    # Chronumental is fitted in-process with the version this was written
+    # against, and otherwise by running the chronumental command
+    installed_version = timetree.chronumental_version()
+    in_process = installed_version == timetree.CHRONUMENTAL_VERSION
+    if not in_process and not timetree.chronumental_command_is_available():
         print("#####  Chronumental is not available.  #####")
         print(
-            "#####  Please install it with `pip install chronumental` and restart. Or you can disable the --chronumental flag.  #####"
+            "#####  Please install it with `pip install taxoniumtools[chronumental]` and restart. Or you can disable the --chronumental flag.  #####"
         )
         print("#####  Exiting.  #####")
         sys.exit(1)
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        mat.tree.write_tree_newick(
-            os.path.join(tmpdirname, "distance_tree.nwk"))
-
-        print("Launching chronumental")
-
-        command = f"chronumental --tree {os.path.join(tmpdirname, 'distance_tree.nwk')} --dates {metadata_file} --steps {chronumental_steps} --tree_out {os.path.join(tmpdirname, 'timetree.nwk')}"
-        if chronumental_reference_node:
-            command += f" --reference_node '{chronumental_reference_node}'"
-
-        if chronumental_date_output:
-            command += f" --dates_out {chronumental_date_output}"
-        result = os.system(command)
-        if result != 0:
-            print("#####  Chronumental failed.  #####")
-            print("#####  Exiting.  #####")
-            sys.exit(1)
-
-        # %%
-
-        print("Reading time tree")
-        time_tree = treeswift.read_tree(os.path.join(tmpdirname,
-                                                     "timetree.nwk"),
-                                        schema="newick")
-        if chronumental_tree_output:
-            shutil.copy2(os.path.join(tmpdirname, "timetree.nwk"),
-                         chronumental_tree_output)
-        time_tree_iter = ushertools.preorder_traversal(time_tree.root)
-        for i, node in alive_it(enumerate(
-                ushertools.preorder_traversal(mat.tree.root)),
-                                title="Adding time tree"):
-            time_tree_node = next(time_tree_iter)
-
-            node.time_length = time_tree_node.edge_length
-        del time_tree
-        del time_tree_iter
-
-        if chronumental_add_inferred_date:
-            print(
-                f"Adding chronumental inferred date as metadata-like item {chronumental_add_inferred_date}"
-            )
-            if chronumental_date_output:
-                date_output_filename = chronumental_date_output
-            else:
-                metadata_dir = os.path.dirname(metadata_file)
-                metadata_base = os.path.basename(metadata_file)
-                date_output_filename = f"chronumental_dates_{metadata_base}.tsv"
-                if metadata_dir:
-                    date_output_filename = metadata_dir + "/" + date_output_filename
-                if not os.path.exists(date_output_filename):
-                    raise FileNotFoundError(
-                        errno.ENOENT,
-                        f"Can't find default date output file in the expected location (try specifying a file name with --chronumental_date_output)",
-                        date_output_filename)
-            metadata_cols.append(chronumental_add_inferred_date)
-            inferred_dates = pd.read_csv(
-                date_output_filename,
-                sep="\t" if metadata_file.endswith(".tsv")
-                or metadata_file.endswith(".tsv.gz") else ",",
-                usecols=['strain', 'predicted_date'])
-            for idx, row in inferred_dates.iterrows():
-                node_name = row['strain']
-                inferred_date = row['predicted_date']
-                # Add inferred_date even if a node (e.g. internal node) has no metadata
-                if node_name not in metadata_dict:
-                    metadata_dict[node_name] = {
-                        col: ""
-                        for col in metadata_cols
-                    }
-                metadata_dict[node_name][
-                    chronumental_add_inferred_date] = inferred_date
-            del inferred_dates
-
-
-def set_x_coords(root, chronumental_enabled):
-    """ Set x coordinates for the tree"""
-    root.x_dist = 0
-    root.x_time = 0
-    for node in alive_it(root.traverse_preorder(),
-                         title="Setting x coordinates"):
-        if node.parent:
-            node.x_dist = node.parent.x_dist + node.edge_length
-            if chronumental_enabled:
-                node.x_time = node.parent.x_time + node.time_length
-
-    normalise_specific_x_coords(root, "x_dist", fixed_val=600)
-    if chronumental_enabled:
-        normalise_specific_x_coords(root, "x_time", fixed_val=600)
-
-
-def normalise_specific_x_coords(root, attr, fixed_val=75):
-    """List all x-coordinates, then find the 95th percentile and normalise it to be the fixed val"""
-    x_coords = [getattr(node, attr) for node in root.traverse_preorder()]
-    x_coords = sorted(x_coords)
-    percentile_95 = x_coords[int(len(x_coords) * 0.95)]
-    for node in alive_it(list(root.traverse_preorder()),
-                         title="Normalising x coordinates"):
-        setattr(node, attr, fixed_val * (getattr(node, attr) / percentile_95))
-
-
-def set_terminal_y_coords(root):
-    for i, node in alive_it(enumerate(root.traverse_leaves()),
-                            title="Setting terminal y coordinates"):
-        node.y = i
-        node.y = i
-
-
-def set_internal_y_coords(root):
-    # Each node should be halfway between the min and max y of its children
-    for node in alive_it(root.traverse_postorder(leaves=False, internal=True),
-                         title="Setting internal y coordinates"):
-
-        child_ys = [child.y for child in node.children]
-        node.y = (min(child_ys) + max(child_ys)) / 2
-
-
-def get_all_aa_muts(root):
-    all_aa_muts = set()
-    for node in alive_it(list(root.traverse_preorder()),
-                         title="Collecting all AA mutations"):
-        if hasattr(node, 'aa_muts'):
-            all_aa_muts.update(node.aa_muts)
-    return list(all_aa_muts)
-
-
-def get_all_nuc_muts(root):
-    all_nuc_muts = set()
-    for node in alive_it(list(root.traverse_preorder()),
-                         title="Collecting all nuc mutations"):
-        if node.nuc_mutations:
-            all_nuc_muts.update(node.nuc_mutations)
-    return list(all_nuc_muts)
-
-
-def make_aa_object(i, aa_mutation):
-    # Tuple format is gene, position, prev, next
-
-    return {
-        "gene": aa_mutation.gene,
-        "previous_residue": aa_mutation.initial_aa,
-        "residue_pos": aa_mutation.one_indexed_codon,
-        "new_residue": aa_mutation.final_aa,
+    if metadata_file is None:
+        raise ValueError(
+            "Chronumental needs a metadata file with a date column")
+    # As the chronumental command does, the dates table is always written,
+    # by default next to the metadata file
+    if not chronumental_date_output:
+        chronumental_date_output = timetree.default_date_output(metadata_file)
+
+    print("Launching chronumental")
+    if in_process:
+        if "date" in metadata.columns:
+            dates_metadata = metadata
+        else:
+            leaf_names = {tree.labels[i] for i in np.flatnonzero(tree.is_leaf)}
+            dates_metadata = read_metadata_table(metadata_file, {"date"},
+                                                 key_column,
+                                                 keys=leaf_names - {None})
+        time_length, node_dates = timetree.run_chronumental(
+            tree,
+            dates_metadata,
+            steps=chronumental_steps,
+            reference_node=chronumental_reference_node)
+        # Dates are reported for named nodes
+        named = [i for i, label in enumerate(tree.labels) if label]
+        names = [tree.labels[i] for i in named]
+        predicted_dates = timetree.format_dates(node_dates[named])
+        pd.DataFrame({
+            "strain": names,
+            "predicted_date": predicted_dates
+        }).to_csv(chronumental_date_output, sep="\t", index=False)
+        print(f"Wrote predicted dates to {chronumental_date_output}")
+    else:
+        print(
+            f"Running the chronumental command, as Chronumental {timetree.CHRONUMENTAL_VERSION} is not installed here"
+        )
+        time_length, names, predicted_dates = timetree.run_chronumental_command(
+            tree,
+            metadata_file,
+            chronumental_date_output,
+            steps=chronumental_steps,
+            reference_node=chronumental_reference_node)
+    tree.columns["time_length"] = time_length
+    if chronumental_tree_output:
+        tree.write_tree_newick(chronumental_tree_output, lengths="time_length")
+
+    if chronumental_add_inferred_date:
+        print(
+            f"Adding chronumental inferred date as metadata-like item {chronumental_add_inferred_date}"
+        )
+        metadata_cols.append(chronumental_add_inferred_date)
+        # Inferred dates are added even for nodes (e.g. internal nodes)
+        # with no metadata
+        metadata.add_column(chronumental_add_inferred_date, names,
+                            predicted_dates)
+
+
+def make_aa_objects(table, ids, first_id):
+    gene_names = table.codons.gene_names
+    return [{
+        "gene": gene_names[gene],
+        "previous_residue": chr(initial_aa),
+        "residue_pos": codon,
+        "new_residue": chr(final_aa),
         "mutation_id": i,
-        "nuc_for_codon": aa_mutation.nuc_for_codon,
+        "nuc_for_codon": nuc_for_codon,
         "type": "aa"
-    }
+    } for i, gene, codon, initial_aa, final_aa, nuc_for_codon in zip(
+        itertools.count(first_id), table.gene[ids].tolist(),
+        table.one_indexed_codon[ids].tolist(), table.initial_aa[ids].tolist(),
+        table.final_aa[ids].tolist(), table.nuc_for_codon[ids].tolist())]
 
 
-def make_nuc_object(i, nuc_mut):
-    return {
+def make_nuc_objects(table, ids, first_id):
+    return [{
         "gene": "nt",
-        "previous_residue": nuc_mut.par_nuc,
-        "residue_pos": nuc_mut.one_indexed_position,
-        "new_residue": nuc_mut.mut_nuc,
+        "previous_residue": table.alphabet[par_nuc],
+        "residue_pos": position,
+        "new_residue": table.alphabet[mut_nuc],
         "mutation_id": i,
         "type": "nt"
     }
-
-
-def get_node_object(node, node_to_index, metadata, input_to_index, columns,
-                    chronumental_enabled):
+            for i, position, par_nuc, mut_nuc in zip(
+                itertools.count(first_id), table.position[ids].tolist(),
+                table.par_nuc[ids].tolist(), table.mut_nuc[ids].tolist())]
+
+
+# The tree's ragged columns of mutation ids, in the order their mutations are
+# numbered and listed for each node
+MUTATION_COLUMNS = {
+    "aa_muts": make_aa_objects,
+    "nuc_mutations": make_nuc_objects
+}
+
+
+def number_mutations(tree):
+    """Number the mutations found on any node, amino acid ones first.
+
+    Returns the mutation objects for the header, and for each of the tree's
+    mutation columns an array mapping its table's ids to these numbers (-1
+    for mutations that are on no node)."""
+    mutation_objects = []
+    mutation_ids = {}
+    for name, make_objects in MUTATION_COLUMNS.items():
+        if name not in tree.ragged:
+            continue
+        column = tree.ragged[name]
+        used = np.zeros(len(column.table), dtype=bool)
+        used[column.values] = True
+        ids = np.full(len(column.table), -1, dtype=np.int64)
+        ids[used] = np.arange(len(mutation_objects),
+                              len(mutation_objects) + np.count_nonzero(used))
+        mutation_objects.extend(
+            make_objects(column.table, np.flatnonzero(used),
+                         len(mutation_objects)))
+        mutation_ids[name] = ids
+    return mutation_objects, mutation_ids
+
+
+def get_tree_names(tree):
+    """The distinct node labels of a tree, the only keys needed from the
+    metadata"""
+    return {label for label in tree.labels if label}
+
+
+def get_root_sequence_segments(root_sequence, positions=None):
+    """Compact record of the root sequence as [one-indexed start, sequence]
+    segments, optionally covering only the given sorted one-indexed positions"""
+    if positions is None:
+        return [[1, root_sequence]] if root_sequence else []
+    positions = np.asarray(positions, dtype=np.int64)
+    positions = positions[(positions >= 1) & (positions <= len(root_sequence))]
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    starts = np.concatenate([[0], breaks]).tolist()
+    ends = np.concatenate([breaks, [len(positions)]]).tolist()
+    return [[
+        int(positions[start]),
+        root_sequence[positions[start] - 1:positions[end - 1]]
+    ] for start, end in zip(starts, ends) if end > start]
+
+
+def get_node_object(node,
+                    node_to_index,
+                    metadata,
+                    mutation_ids,
+                    columns,
+                    chronumental_enabled,
+                    metadata_row=None):
+    """metadata_row is the node's row in the metadata table, if already
+    looked up (-1 if it has none)"""
 
     object = {}
     object["name"] = node.label if node.label else ""
@@ -225,31 +203,25 @@ def get_node_object(node, node_to_index, metadata, input_to_index, columns,
     object["x_dist"] = round(node.x_dist, 5)
     if chronumental_enabled:
         object["x_time"] = round(node.x_time, 5)
-    object["y"] = node.y
+    # Tips sit on whole-number rows
+    object["y"] = int(node.y) if node.is_leaf() else node.y
     object['mutations'] = []
-    if hasattr(node, 'aa_muts'):
-        object['mutations'] += [
-            input_to_index[my_input] for my_input in node.aa_muts
-        ]
-    if hasattr(node, 'nuc_mutations'):
-        object['mutations'] += [
-            input_to_index[my_input] for my_input in node.nuc_mutations
-        ]
+    for name, ids in mutation_ids.items():
+        node_ids = ids[node.tree.ragged[name][node.index]]
+        if np.any(node_ids < 0):
+            raise KeyError("Mutation missing from the mutation list")
+        object['mutations'] += node_ids.tolist()
     if node.is_leaf():
         object['is_tip'] = True
     else:
         object['is_tip'] = False
 
-    # check if label is in metadata's index
-    try:
-        my_dict = metadata[node.label]
-        for key in my_dict:
-            value = my_dict[key]
-            #if value is pd.NaN then set to empty string
-            if pd.isna(value):
-                value = ""
+    if metadata_row is None:
+        metadata_row = metadata.lookup([node.label])[0]
+    if metadata_row >= 0:
+        for key, value in metadata.get(metadata_row):
             object["meta_" + key] = value
-    except KeyError:
+    else:
         for key in columns:
             object["meta_" + key] = ""
 
@@ -266,13 +238,262 @@ def get_node_object(node, node_to_index, metadata, input_to_index, columns,
     return object
 
 
-def sort_on_y(tree):
-    with alive_bar(title="Sorting on y") as bar:
+SERIALIZE_BLOCK_SIZE = 20000
+
+
+def dump_each(values):
+    """orjson encodings of each of a list of numbers, from one call"""
+    if not values:
+        return []
+    return orjson.dumps(values)[1:-1].split(b",")
+
+
+class NodeSerializer:
+    """Encodes nodes as jsonl lines, a block at a time, straight from the
+    tree's arrays and the columnar metadata.
+
+    The bytes are the same as orjson.dumps of get_node_object's objects, but
+    key prefixes and metadata values are encoded once up front and numbers
+    are encoded a block at a time.
+    """
+
+    def __init__(self,
+                 tree,
+                 order,
+                 metadata,
+                 metadata_rows,
+                 mutation_ids,
+                 columns,
+                 chronumental_enabled,
+                 remove_after_pipe=False):
+        self.tree = tree
+        self.order = np.asarray(order, dtype=np.int64)
+        self.node_id = np.empty(tree.num_nodes(), dtype=np.int64)
+        self.node_id[self.order] = np.arange(len(self.order))
+        self.parent_id = self.node_id[np.where(tree.parent >= 0, tree.parent,
+                                               np.arange(tree.num_nodes()))]
+        self.metadata = metadata
+        self.metadata_rows = np.asarray(metadata_rows, dtype=np.int64)
+        self.mutation_ids = mutation_ids
+        self.chronumental_enabled = chronumental_enabled
+        self.remove_after_pipe = remove_after_pipe
+
+        self.template = (b'{"name":%s,"x_dist":%s' +
+                         (b',"x_time":%s' if chronumental_enabled else b'') +
+                         b',"y":%s,"mutations":%s,"is_tip":%s%s'
+                         b',"parent_id":%s,"node_id":%s,"num_tips":%s%s}\n')
+
+        # Each metadata column's values (with missing ones first) encoded
+        # with their key
+        self.metadata_pieces = {}
+        for column in metadata.columns:
+            key = orjson.dumps("meta_" + column) + b":"
+            self.metadata_pieces[column] = np.array([b"," + key + b'""'] + [
+                b"," + key + orjson.dumps(x) for x in metadata.values[column]
+            ],
+                                                    dtype=object)
+        self.no_metadata = b"".join(b"," + orjson.dumps("meta_" + column) +
+                                    b':""' for column in columns)
+
+        # Each clade type's values as codes, and the encoding of each value
+        # with its key (and a leading comma), missing ones being empty
+        self.clade_codes = []
+        self.clade_pieces = []
+        for clade_type, values in tree.clades.items():
+            codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+            key = b"," + orjson.dumps(clade_type) + b":"
+            self.clade_codes.append(codes)
+            self.clade_pieces.append(
+                np.array([b""] + [key + orjson.dumps(x) for x in uniques],
+                         dtype=object))
+
+    def _mutations(self, nodes):
+        # All of the block's ids, each node's from each mutation column in
+        # turn, encoded with one call and sliced per node
+        counts = np.zeros(len(nodes), dtype=np.int64)
+        owners = []
+        ids = []
+        for name, column_ids in self.mutation_ids.items():
+            column = self.tree.ragged[name]
+            column_counts = column.lengths()[nodes]
+            counts += column_counts
+            owners.append(np.repeat(np.arange(len(nodes)), column_counts))
+            ids.append(column_ids[gather_ranges(column.offsets, nodes,
+                                                column.values)])
+        offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        if ids:
+            ids = np.concatenate(ids)[np.argsort(np.concatenate(owners),
+                                                 kind="stable")]
+            if np.any(ids < 0):
+                raise KeyError("Mutation missing from the mutation list")
+            encoded = dump_each(ids.tolist())
+        else:
+            encoded = []
+        offsets = offsets.tolist()
+        return [
+            b"[" + b",".join(encoded[start:stop]) + b"]"
+            for start, stop in zip(offsets[:-1], offsets[1:])
+        ]
+
+    def _metadata(self, positions):
+        if not self.metadata_pieces:
+            return [b""] * len(positions)
+        rows = self.metadata_rows[positions]
+        encoded = []
+        for column, pieces in self.metadata_pieces.items():
+            codes = self.metadata.column_codes(column, rows)
+            encoded.append(pieces[codes + 1])
+        joined = [b"".join(x) for x in zip(*encoded)]
+        for i in np.flatnonzero(rows < 0).tolist():
+            joined[i] = self.no_metadata
+        return joined
+
+    def _clades(self, nodes):
+        if not self.clade_pieces:
+            return [b""] * len(nodes)
+        encoded = [
+            pieces[codes[nodes] + 1]
+            for codes, pieces in zip(self.clade_codes, self.clade_pieces)
+        ]
+        return [b',"clades":{' + b"".join(x)[1:] + b"}" for x in zip(*encoded)]
+
+    def lines(self, start, stop):
+        """The jsonl lines for nodes start to stop (in y order), as bytes"""
+        tree = self.tree
+        positions = np.arange(start, stop)
+        nodes = self.order[start:stop]
+        is_leaf = tree.is_leaf[nodes]
+
+        names = [tree.labels[node] or "" for node in nodes.tolist()]
+        if self.remove_after_pipe:
+            names = [name.split("|")[0] for name in names]
+        fields = [[orjson.dumps(name) for name in names]]
+        fields.append(
+            dump_each(
+                [round(x, 5) for x in tree.columns["x_dist"][nodes].tolist()]))
+        if self.chronumental_enabled:
+            fields.append(
+                dump_each([
+                    round(x, 5)
+                    for x in tree.columns["x_time"][nodes].tolist()
+                ]))
+        fields.append(
+            dump_each([
+                int(y) if leaf else y for y, leaf in zip(
+                    tree.columns["y"][nodes].tolist(), is_leaf.tolist())
+            ]))
+        fields.append(self._mutations(nodes))
+        fields.append(
+            [b"true" if leaf else b"false" for leaf in is_leaf.tolist()])
+        fields.append(self._metadata(positions))
+        fields.append(dump_each(self.parent_id[nodes].tolist()))
+        fields.append(dump_each(positions.tolist()))
+        fields.append(dump_each(tree.columns["num_tips"][nodes].tolist()))
+        fields.append(self._clades(nodes))
+        template = self.template
+        return b"".join([template % values for values in zip(*fields)])
+
+
+class JsonlWriter:
+    """Writes the header and then each node object as a line of JSON"""
+
+    def __init__(self,
+                 filename,
+                 header,
+                 compression_threads=1,
+                 compression_level=9):
+        self.filename = filename
+        if "gz" in filename:
+            self.file = parallel_gzip.open_gzip(filename, compression_threads,
+                                                compression_level)
+        else:
+            self.file = open(filename, 'wb')
+        self.file.write(orjson.dumps(header) + b"\n")
+
+    def write(self, node_object):
+        self.file.write(orjson.dumps(node_object) + b"\n")
+
+    def write_lines(self, lines):
+        self.file.write(lines)
+
+    def close(self):
+        self.file.close()
+
+
+def open_output(filename,
+                header,
+                output_format,
+                metadata,
+                compression_threads=1,
+                compression_level=9):
+    """A writer of node objects in the given format ("jsonl" or "arrow").
+    Compression settings apply to gzipped jsonl."""
+    if output_format == "arrow":
+        value_hints = {
+            "meta_" + column: metadata.values[column] + [""]
+            for column in metadata.columns
+        }
+        return columnar.ColumnarWriter(filename,
+                                       header,
+                                       value_hints=value_hints)
+    return JsonlWriter(filename, header, compression_threads,
+                       compression_level)
+
+
+def write_nodes(writer,
+                tree,
+                order,
+                metadata,
+                mutation_ids,
+                columns,
+                chronumental_enabled,
+                remove_after_pipe=False,
+                block_size=SERIALIZE_BLOCK_SIZE):
+    """Write every node, in the given order of node indices, with the given
+    writer"""
+    metadata_rows = metadata.lookup([tree.labels[i]
+                                     for i in order.tolist()]).tolist()
+    if isinstance(writer, JsonlWriter):
+        serializer = NodeSerializer(tree,
+                                    order,
+                                    metadata,
+                                    metadata_rows,
+                                    mutation_ids,
+                                    columns,
+                                    chronumental_enabled,
+                                    remove_after_pipe=remove_after_pipe)
+        with alive_bar(
+                len(order),
+                title="Converting each node, and writing out in JSON") as bar:
+            for start in range(0, len(order), block_size):
+                stop = min(start + block_size, len(order))
+                writer.write_lines(serializer.lines(start, stop))
+                bar(stop - start)
+        return
+
+    nodes_sorted_by_y = [tree.node(index) for index in order.tolist()]
+    node_to_index = {node: i for i, node in enumerate(nodes_sorted_by_y)}
+    for node, metadata_row in alive_it(zip(nodes_sorted_by_y, metadata_rows),
+                                       total=len(nodes_sorted_by_y),
+                                       title="Converting each node"):
+        node_object = get_node_object(
+            node,
+            node_to_index,
+            metadata,
+            mutation_ids,
+            columns,
+            chronumental_enabled=chronumental_enabled,
+            metadata_row=metadata_row)
+        if remove_after_pipe and 'name' in node_object and node_object['name']:
+            node_object['name'] = node_object['name'].split("|")[0]
+        writer.write(node_object)
 
-        def return_y(node):
-            bar()
-            return node.y
 
-        nodes_sorted_by_y = sorted(tree.root.traverse_preorder(),
-                                   key=lambda x: return_y(x))
-    return nodes_sorted_by_y
+def sort_on_y(tree):
+    """Node indices in order of y. Ties keep the order of
+    traverse_preorder(), as in a stable sort of that traversal."""
+    print("Sorting on y")
+    # traverse_preorder() is the reverse of a left-to-right postorder
+    preorder_rank = tree.num_nodes() - 1 - tree.postorder_rank()
+    return np.lexsort((preorder_rank, tree.columns["y"]))